@@ -0,0 +1,155 @@
+# alignmentIO.py reads and writes BAM files as SAM-formatted text lines, so that parseBarcodes and compareSam can
+# keep working on SAM records while reading BAM input and writing BAM output directly (no samtools conversion
+# step before or after). BAM support requires pysam (pip install pysam), which is only imported when a BAM file
+# is used. BGZF (de)compression runs on the number of threads given.
+# Plain text files (SAM, FASTQ) are opened through open_text, which handles gzipped (.gz) files and '-' for
+# stdin/stdout, or through open_binary to read and write them as bytes lines (no decoding to str).
+# read_line_blocks reads a binary file in large blocks of whole lines instead of line by line.
+import gzip
+import itertools
+import os
+import sys
+
+# pysam, imported by require_pysam
+pysam = None
+
+
+def is_bam(path):
+    # Function 1 "is_bam" decides the file format from the file extension
+    return path.lower().endswith('.bam')
+
+
+def is_fastq(path):
+    # Function 1b "is_fastq" decides from the file extension if a file is (gzipped) FASTQ
+    return path.lower().endswith(('.fastq', '.fq', '.fastq.gz', '.fq.gz'))
+
+
+def file_format(path):
+    # Function 1d "file_format" returns 'bam', 'fastq' or 'sam' from the file extension. '-' (stdin/stdout) and
+    # unknown extensions are SAM.
+    if is_bam(path):
+        return 'bam'
+    if is_fastq(path):
+        return 'fastq'
+    return 'sam'
+
+
+def open_text(path, mode='r'):
+    # Function 1c "open_text" opens a text file for reading ('r') or writing ('w'), gzipped if it ends in .gz.
+    # '-' opens stdin ('r') or stdout ('w'). Closing those flushes them but leaves the stream itself open.
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return os.fdopen(stream.fileno(), mode, closefd=False)
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def open_binary(path, mode='r'):
+    # Function 1f "open_binary" opens a file as open_text does, in binary mode: lines are read and written as bytes
+    if path == '-':
+        stream = sys.stdin if mode == 'r' else sys.stdout
+        return os.fdopen(stream.fileno(), mode + 'b', closefd=False)
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+
+def split_sam_header(sam_file):
+    # Function 1e "split_sam_header" reads the header lines (all lines starting with @) at the top of an open SAM
+    # file (text or binary). Returns the header lines and an iterator over the records that follow them.
+    header_lines = []
+    for line in sam_file:
+        if line[:1] not in ('@', b'@'):
+            return header_lines, itertools.chain([line], sam_file)
+        header_lines.append(line)
+    return header_lines, iter([])
+
+
+def read_line_blocks(first_lines, stream, lines, block_size=1 << 20):
+    # Function 1g "read_line_blocks" reads an open binary file in reads of block_size bytes and yields bytes
+    # buffers of lines whole lines each (the last buffer can hold fewer). first_lines are lines already read from
+    # the file, e.g. the first record returned by split_sam_header. Only the block in which a buffer ends is
+    # searched line by line, every other block is counted in one call.
+    pieces = list(first_lines)
+    buffered = len(pieces)
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        newlines = block.count(b'\n')
+        while buffered + newlines >= lines:
+            cut = 0
+            for _ in range(lines - buffered):
+                cut = block.index(b'\n', cut) + 1
+            pieces.append(block[:cut])
+            yield b''.join(pieces)
+            block = block[cut:]
+            newlines -= lines - buffered
+            pieces = []
+            buffered = 0
+        pieces.append(block)
+        buffered += newlines
+
+    remainder = b''.join(pieces)
+    if remainder:
+        yield remainder
+
+
+def require_pysam():
+    # Function 2 "require_pysam" imports pysam, or ends the program if BAM files are used without pysam installed
+    global pysam
+    if pysam is None:
+        try:
+            import pysam
+        except ImportError:
+            print("Reading or writing BAM files requires pysam (pip install pysam). Ending program...")
+            sys.exit()
+
+
+class BamTextReader:
+    # Reads a BAM file. header_lines holds the header as SAM text lines and iterating
+    # over the reader yields every record as a SAM text line, in file order. binary gives bytes lines.
+
+    def __init__(self, path, threads=1, binary=False):
+        require_pysam()
+        try:
+            self.bam = pysam.AlignmentFile(path, 'rb', check_sq=False, threads=threads)
+        except (IOError, ValueError):
+            print("Could not open BAM file for reading. Ending program...")
+            sys.exit()
+        self.header_lines = [line + '\n' for line in str(self.bam.header).splitlines() if line]
+        self.binary = binary
+        if binary:
+            self.header_lines = [line.encode() for line in self.header_lines]
+
+    def __iter__(self):
+        if self.binary:
+            for segment in self.bam.fetch(until_eof=True):
+                yield (segment.to_string() + '\n').encode()
+            return
+        for segment in self.bam.fetch(until_eof=True):
+            yield segment.to_string() + '\n'
+
+    def close(self):
+        self.bam.close()
+
+
+class BamTextWriter:
+    # Writes SAM text lines (one or many records per call, newline separated) to a BGZF-compressed BAM file.
+    # header_lines is the SAM header of the output as a list of text lines. Lines may also be bytes.
+
+    def __init__(self, path, header_lines, threads=1):
+        require_pysam()
+        self.header = pysam.AlignmentHeader.from_text(''.join(line.decode() if isinstance(line, bytes) else line
+                                                              for line in header_lines))
+        self.bam = pysam.AlignmentFile(path, 'wb', header=self.header, threads=threads)
+
+    def write(self, sam_text):
+        if isinstance(sam_text, bytes):
+            sam_text = sam_text.decode()
+        for line in sam_text.splitlines():
+            self.bam.write(pysam.AlignedSegment.fromstring(line, self.header))
+
+    def close(self):
+        self.bam.close()
@@ -0,0 +1,243 @@
+# batchDecoder.py decodes read 1 of many read pairs at once with NumPy. ddSeq read 1 has a fixed length, so a
+# batch of sequences and qualities is loaded into 2-D uint8 arrays (one row per read) and every check of
+# decode_read1 in parseBarcodes is done as a whole-array operation: linker mismatch counts at every offset, the
+# N scan, the ACG/GAC anchors, barcode block correction (through an integer lookup table) and the quality filter.
+# The results and counts (including the run metrics of runMetrics) are identical to decode_read1, read for read.
+# Reads the arrays cannot represent (sequence and quality of different lengths, reads shorter than a linker, linker
+# 1 too close to the start to hold a phase block) are handed to the decode_read1 function given as fallback.
+# Requires numpy (pip install numpy), which is only imported when the batch decoder is used (require_numpy), so
+# runs with the other decoders do not pay for the import.
+import importlib.util
+import sys
+
+from runMetrics import PHASE_BLOCKS, phase_key
+
+# numpy, imported by require_numpy
+np = None
+
+# Same read 1 structure as in parseBarcodes
+LINKER1 = 'TAGCCATCGCATTGC'
+LINKER2 = 'TACCTCTGAGCTGAA'
+
+# Blocks are encoded with 3 bits per base so that a 6-mer is an integer below 8 ** 6
+BLOCK_LENGTH = 6
+BASE_BITS = 3
+
+# Correction table of the last correction index seen, see get_block_table
+cached_block_table = (None, None)
+
+
+def has_numpy():
+    # Function 1 "has_numpy" tells if numpy is installed, without importing it
+    return np is not None or importlib.util.find_spec('numpy') is not None
+
+
+def require_numpy():
+    # Function 1b "require_numpy" imports numpy, or ends the program if the batch decoder is used without numpy
+    # installed
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            print("The batch decoder requires numpy (pip install numpy). Ending program...")
+            sys.exit()
+
+
+def base_codes():
+    # Function 2 "base_codes" maps every ASCII code to a 3-bit base code: A, C, G, T, N are 0-4 and anything
+    # else is 5, so that it never matches a block in the correction table
+    codes = np.full(256, 5, dtype=np.int32)
+    for code, base in enumerate('ACGTN'):
+        codes[ord(base)] = code
+    return codes
+
+
+def build_block_table(correction_index):
+    # Function 3 "build_block_table" turns the correction index of parseBarcodes into an integer lookup table.
+    # table[encoded 6-mer] is the position of the corrected block in blocks, or -1 when the 6-mer cannot be
+    # corrected (not within 1 mismatch, or ambiguous). corrected[encoded 6-mer] is True for 6-mers that are not
+    # an exact match of their block.
+    codes = base_codes()
+    blocks = sorted(set(block for block in correction_index.values() if block))
+    block_numbers = {block: number for number, block in enumerate(blocks)}
+
+    table = np.full(1 << (BASE_BITS * BLOCK_LENGTH), -1, dtype=np.int16)
+    corrected = np.zeros(1 << (BASE_BITS * BLOCK_LENGTH), dtype=bool)
+    for barcode_block, block in correction_index.items():
+        if block and len(barcode_block) == BLOCK_LENGTH:
+            encoded = 0
+            for base in as_bytes([barcode_block]):
+                encoded = (encoded << BASE_BITS) | int(codes[base])
+            table[encoded] = block_numbers[block]
+            corrected[encoded] = barcode_block != block
+
+    return table, corrected, blocks
+
+
+def as_bytes(texts):
+    # Function 3b "as_bytes" joins a list of str or bytes sequences into one bytes object of one byte per
+    # character (non-ASCII characters become ?)
+    if texts and isinstance(texts[0], bytes):
+        return b''.join(texts)
+    return ''.join(texts).encode('ascii', 'replace')
+
+
+def get_block_table(correction_index):
+    # Function 4 "get_block_table" builds the lookup table once per correction index and reuses it for every
+    # following batch
+    global cached_block_table
+    if cached_block_table[0] is not correction_index:
+        cached_block_table = (correction_index, build_block_table(correction_index))
+    return cached_block_table[1]
+
+
+def gather(array, rows, starts, length):
+    # Function 5 "gather" returns array[row, start:start + length] for every row/start pair as a 2-D array.
+    # Positions past the end of the read are clipped; callers ignore the rows where that happens.
+    columns = np.minimum(starts[:, None] + np.arange(length), array.shape[1] - 1)
+    return array[rows[:, None], columns]
+
+
+def mismatch_counts(seqs, linker):
+    # Function 6 "mismatch_counts" counts the mismatches against linker at every offset of every read
+    linker_codes = np.frombuffer(linker.encode('ascii'), dtype=np.uint8)
+    offsets = seqs.shape[1] - len(linker) + 1
+    mismatches = np.zeros((seqs.shape[0], offsets), dtype=np.int8)
+    for k, base in enumerate(linker_codes):
+        mismatches += seqs[:, k:k + offsets] != base
+    return mismatches
+
+
+def find_first(seqs, rows, starts, length, window_start, window_end):
+    # Function 7 "find_first" emulates str.find(seq[start:start + length], window_start, window_end) on every
+    # read: the first offset in the window holding the same bases, or -1
+    window_end = min(window_end, seqs.shape[1])
+    candidates = range(window_start, window_end - length + 1)
+    if not candidates:
+        return np.full(len(rows), -1)
+
+    target = gather(seqs, rows, starts, length)
+    found = np.stack([(seqs[:, c:c + length] == target).all(axis=1) for c in candidates], axis=1)
+    return np.where(found.any(axis=1), window_start + found.argmax(axis=1), -1)
+
+
+def has_low_quality(quals, rows, starts):
+    # Function 8 "has_low_quality" mirrors check_bc_quality: any of the 6 quality values from start is below
+    # 43 (q-score 10). A start of -1 (block not found) checks nothing.
+    positions = starts[:, None] + np.arange(BLOCK_LENGTH)
+    valid = (starts[:, None] >= 0) & (positions < quals.shape[1])
+    values = quals[rows[:, None], np.minimum(positions, quals.shape[1] - 1)]
+    return ((values < 43) & valid).any(axis=1)
+
+
+def decode_group(seqs, quals, table, corrected, counts):
+    # Function 9 "decode_group" decodes reads of one length. seqs and quals are (reads x length) uint8 arrays.
+    # Returns an outcome per read (0 dropped, 1 barcode found, 2 needs the fallback decoder), the block numbers of
+    # bc1, bc2 and bc3, and the end of linker 2 (the UMI starts 9 bases after it).
+    n_reads, read_length = seqs.shape
+    rows = np.arange(n_reads)
+    outcome = np.zeros(n_reads, dtype=np.int8)
+
+    # leftmost linker 1 and rightmost linker 2 with up to 1 substitution, as the regex search finds them
+    linker1_hits = mismatch_counts(seqs, LINKER1) <= 1
+    linker2_hits = mismatch_counts(seqs, LINKER2) <= 1
+    linker_ok = linker1_hits.any(axis=1) & linker2_hits.any(axis=1)
+    linker1_start = linker1_hits.argmax(axis=1)
+    linker2_start = linker2_hits.shape[1] - 1 - linker2_hits[:, ::-1].argmax(axis=1)
+    linker1_end = linker1_start + 15
+    linker2_end = linker2_start + 15
+    counts['bad_linker'] += int((~linker_ok).sum())
+
+    # linker 1 within 6 bases of the start leaves no room for bc1. decode_read1 handles those oddities.
+    fallback = linker_ok & (linker1_start < 6)
+    outcome[fallback] = 2
+    todo = linker_ok & ~fallback
+    # linker positions of the reads decoded here, as linker_key of runMetrics
+    fixed_offset = todo & (linker1_start < 6 + len(PHASE_BLOCKS)) & (linker2_start == linker1_start + 21)
+    counts['linkers:fixed_offset'] += int(fixed_offset.sum())
+    counts['linkers:shifted'] += int((todo & ~fixed_offset).sum())
+
+    # remove reads with an N base up to the GAC anchor
+    n_bases = np.cumsum(seqs == ord('N'), axis=1)
+    n_base = todo & (n_bases[rows, np.minimum(linker2_end + 20, read_length) - 1] > 0)
+    counts['n_base'] += int(n_base.sum())
+    todo &= ~n_base
+
+    # ACG and GAC anchors must be intact and there must be a base after the GAC anchor
+    post_base = linker2_end + 20 < read_length
+    anchors = (gather(seqs, rows, linker2_end + 6, 3) == np.frombuffer(b'ACG', dtype=np.uint8)).all(axis=1) & \
+              (gather(seqs, rows, linker2_end + 17, 3) == np.frombuffer(b'GAC', dtype=np.uint8)).all(axis=1)
+    bad_anchor = todo & ~(post_base & anchors)
+    counts['bad_block'] += int(bad_anchor.sum())
+    todo &= ~bad_anchor
+
+    # barcode block correction through the lookup table
+    codes = base_codes()[seqs]
+    weights = 1 << (BASE_BITS * np.arange(BLOCK_LENGTH - 1, -1, -1))
+    mod = linker1_start - 6
+    block_codes = [(gather(codes, rows, starts, BLOCK_LENGTH) * weights).sum(axis=1)
+                   for starts in (mod, linker1_end, linker2_end)]
+    bc1, bc2, bc3 = [table[block_code] for block_code in block_codes]
+    bc2[linker2_start - linker1_end != BLOCK_LENGTH] = -1
+    bad_block = todo & ((bc1 < 0) | (bc2 < 0) | (bc3 < 0))
+    counts['bad_block'] += int(bad_block.sum())
+    todo &= ~bad_block
+
+    # no low quality barcode bases allowed. Blocks are located with str.find semantics, as in demultiplex
+    low_quality = np.zeros(n_reads, dtype=bool)
+    for starts, length, window_start, window_end in ((mod, 6, 0, 20), (linker1_end, 6, 20, 41),
+                                                     (linker2_end, 6, 41, 55), (linker2_end + 9, 8, 48, 68)):
+        block_index = find_first(seqs, rows, starts, length, window_start, window_end)
+        low_quality |= has_low_quality(quals, rows, block_index)
+    low_quality &= todo
+    counts['low_quality'] += int(low_quality.sum())
+    todo &= ~low_quality
+
+    counts['matches'] += int(todo.sum())
+    outcome[todo] = 1
+    for phase_length, phase_count in enumerate(np.bincount(mod[todo], minlength=1)):
+        counts[phase_key(phase_length)] += int(phase_count)
+    for block_name, block_code in zip(['bc1', 'bc2', 'bc3'], block_codes):
+        counts['corrected:' + block_name] += int((todo & corrected[block_code]).sum())
+
+    return outcome, bc1, bc2, bc3, linker2_end
+
+
+def decode_read1_batch(seqs, quals, correction_index, counts, fallback):
+    # Function 10 "decode_read1_batch" decodes a list of read 1 sequences and the matching quality strings.
+    # Returns one (sequence, cell barcode, UMI) tuple per read, or (None, None, None) for dropped reads, exactly
+    # like calling fallback (decode_read1) on each read in turn.
+    require_numpy()
+    table, corrected, blocks = get_block_table(correction_index)
+    results = [None] * len(seqs)
+
+    # group the reads by length. Reads that do not fit the arrays go straight to the fallback decoder
+    groups = {}
+    for i, (seq, qual) in enumerate(zip(seqs, quals)):
+        if len(seq) >= len(LINKER1) and len(seq) == len(qual):
+            groups.setdefault(len(seq), []).append(i)
+        else:
+            results[i] = fallback(seq, qual, correction_index, counts)
+
+    for read_length, members in groups.items():
+        group_seqs = [seqs[i] for i in members]
+        seq_array = np.frombuffer(as_bytes(group_seqs), dtype=np.uint8).reshape(len(members), read_length)
+        qual_array = np.frombuffer(as_bytes([quals[i] for i in members]),
+                                   dtype=np.uint8).reshape(len(members), read_length)
+
+        outcome, bc1, bc2, bc3, linker2_end = decode_group(seq_array, qual_array, table, corrected, counts)
+        counts['batch_decoded'] += int((outcome != 2).sum())
+
+        for row, i in enumerate(members):
+            if outcome[row] == 1:
+                seq = group_seqs[row]
+                umi_start = linker2_end[row] + 9
+                cell_bc = blocks[bc1[row]] + blocks[bc2[row]] + blocks[bc3[row]]
+                results[i] = (seq, cell_bc, seq[umi_start:umi_start + 8])
+            elif outcome[row] == 2:
+                results[i] = fallback(seqs[i], quals[i], correction_index, counts)
+            else:
+                results[i] = (None, None, None)
+
+    return results
@@ -0,0 +1,88 @@
+# batchWriter.py collects the tagged records of parseBarcodes in large buffers and writes every full buffer to the
+# output file with one call, so the output is written in a few big writes instead of one write per chunk (small
+# writes are slow on network file systems). The buffers can be written by a background thread: decoding then goes
+# on while a buffer is written, and only waits when max_pending full buffers are already waiting for the disk.
+# Works with any output file that has write and close (text or binary files, BamTextWriter).
+import queue
+import threading
+import time
+
+# default buffer size in MiB (--write-buffer)
+DEFAULT_BUFFER_MIB = 4
+
+
+class BatchWriter:
+    # Wraps an open output file. write appends to the buffer. Once buffer_size characters (bytes for a binary file)
+    # are buffered, they are joined and written to the file, by a background thread with background. close writes
+    # what is left, waits for the thread and closes the file. An error of the background thread is raised again
+    # by the next write or by close.
+    # writes counts the writes to the file and wait_seconds the time write and close spent waiting for them.
+
+    def __init__(self, output_file, buffer_size=DEFAULT_BUFFER_MIB << 20, background=False, max_pending=2):
+        self.output_file = output_file
+        self.buffer_size = buffer_size
+        self.pieces = []
+        self.buffered = 0
+        self.writes = 0
+        self.wait_seconds = 0.0
+        self.error = None
+        self.pending = None
+        self.thread = None
+        if background:
+            self.pending = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self.write_pending, name='batch-writer', daemon=True)
+            self.thread.start()
+
+    def write(self, data):
+        if not data:
+            return
+        self.pieces.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        # hands the buffered pieces, joined into one string, to the file or to the background thread
+        if not self.pieces:
+            return
+        data = self.pieces[0][:0].join(self.pieces)
+        self.pieces = []
+        self.buffered = 0
+
+        start = time.perf_counter()
+        if self.thread:
+            self.raise_error()
+            self.pending.put(data)
+        else:
+            self.output_file.write(data)
+            self.writes += 1
+        self.wait_seconds += time.perf_counter() - start
+
+    def write_pending(self):
+        # background thread: writes the buffers in the order they were handed over, until None. After an error the
+        # remaining buffers are dropped, so write and close never wait on a full queue.
+        while True:
+            data = self.pending.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.output_file.write(data)
+                    self.writes += 1
+                except BaseException as error:
+                    self.error = error
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.flush_buffer()
+        if self.thread:
+            start = time.perf_counter()
+            self.pending.put(None)
+            self.thread.join()
+            self.wait_seconds += time.perf_counter() - start
+            self.thread = None
+            self.raise_error()
+        self.output_file.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import argparse  # command line options
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+# Summary:
+# benchmarkDecoders.py measures parseBarcodes implementations on equal footing: the current driver with each of
+# its read 1 decoders, and any of the older versions in prototypes/ (they all take -blocks, -input and -output and
+# print the same failure counts).
+# "run" decodes standard synthetic datasets (made once with simulateReads.py and kept in the data directory) with
+# every target and writes the results as JSON: read pairs per second, peak resident memory, and the yield and
+# number of reads per failure category. The startup time of every target (a run on a single read pair: imports,
+# loading the extension, reading the blocks) is measured too, as pipelines launch many short jobs.
+# "compare" checks a results file against a saved baseline and lists the regressions: throughput, memory or startup
+# time worse than the tolerance, or different yields (decoding is deterministic, so any change in counts is a change in
+# behavior). It exits with status 1 if there are any.
+#
+# A target is a script path, optionally followed by :decoder for the current driver, e.g.
+# parseBarcodes-N1.6.1.py:cython or prototypes/parseBarcodes-1.5.py
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# simulateReads.py options of the standard datasets
+DATASETS = {
+    'clean': ['--substitution-rate', '0', '--insertion-rate', '0', '--deletion-rate', '0', '--n-rate', '0',
+              '--low-quality-rate', '0', '--random-rate', '0'],
+    'typical': [],
+    'noisy': ['--substitution-rate', '0.02', '--insertion-rate', '0.002', '--deletion-rate', '0.002', '--n-rate',
+              '0.005', '--low-quality-rate', '0.01', '--random-rate', '0.05'],
+}
+
+DEFAULT_TARGETS = ['parseBarcodes-N1.6.1.py:python', 'parseBarcodes-N1.6.1.py:numpy',
+                   'parseBarcodes-N1.6.1.py:cython']
+
+# failure counts printed by every parseBarcodes version
+FAILURE_LINES = {'bad_phase': 'Bad phases', 'bad_block': 'Bad blocks', 'low_quality': 'Low quality blocks',
+                 'bad_linker': 'Bad linkers'}
+
+# read pairs of the dataset the startup time is measured on
+STARTUP_READS = 1
+# startup changes below this many seconds are noise, not regressions
+STARTUP_SLACK = 0.02
+
+
+def dataset_path(data_dir, dataset, reads):
+    # Function 1 "dataset_path" makes the standard dataset if it does not exist yet and returns its SAM file
+    path = os.path.join(data_dir, '%s_%d.sam' % (dataset, reads))
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print('Making dataset ' + path + '...')
+        subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, 'simulateReads.py'), '-blocks',
+                        os.path.join(SCRIPT_DIR, 's_input', 'barcodeBlocks.txt'), '-reads', str(reads), '-output',
+                        path + '.part', '--truth', path[:-4] + '_truth.tsv'] + DATASETS[dataset], check=True)
+        os.replace(path + '.part', path)
+    return path
+
+
+def run_target(target, input_file, blocks_file):
+    # Function 2 "run_target" decodes input_file with one target in a child process. Returns the wall clock
+    # seconds, the peak resident memory of the child in MiB, the number of tagged read 2 records and the failure
+    # counts, or None if the target failed.
+    script, _, decoder = target.partition(':')
+    with tempfile.TemporaryDirectory() as work_dir:
+        output_file = os.path.join(work_dir, 'output.sam')
+        command = [sys.executable, os.path.join(SCRIPT_DIR, script), '-input', input_file, '-blocks', blocks_file,
+                   '-output', output_file]
+        if decoder:
+            command += ['--decoder', decoder]
+        # the prototypes import editDistance from the top directory
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SCRIPT_DIR, os.environ.get('PYTHONPATH')])))
+
+        with open(os.path.join(work_dir, 'stdout.txt'), 'w+') as stdout:
+            start = time.perf_counter()
+            child = subprocess.Popen(command, stdout=stdout, stderr=subprocess.DEVNULL, env=env, cwd=SCRIPT_DIR)
+            _, status, usage = os.wait4(child.pid, 0)
+            seconds = time.perf_counter() - start
+            child.returncode = os.waitstatus_to_exitcode(status)
+            stdout.seek(0)
+            printed = stdout.read()
+
+        if child.returncode != 0 or not os.path.exists(output_file):
+            return None
+        with open(output_file) as output:
+            records = sum(1 for line in output if not line.startswith('@'))
+
+    failures = {}
+    for key, label in FAILURE_LINES.items():
+        found = re.search('^' + label + r': (\d+)$', printed, re.M)
+        failures[key] = int(found.group(1)) if found else None
+
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+    return seconds, peak_rss, records, failures
+
+
+def run_benchmarks(args):
+    # Function 3 "run_benchmarks" runs every target on every dataset and writes the results to args.output. The
+    # fastest of args.repeat runs counts. The startup time of a target is its fastest run on the startup dataset.
+    blocks_file = os.path.join(SCRIPT_DIR, 's_input', 'barcodeBlocks.txt')
+    results = []
+
+    startup_file = os.path.abspath(dataset_path(args.data_dir, 'typical', STARTUP_READS))
+    startup_seconds = {}
+    for target in args.targets:
+        runs = [run_target(target, startup_file, blocks_file) for _ in range(args.repeat)]
+        if None not in runs:
+            startup_seconds[target] = min(runs)[0]
+            print('%-40s %-8s %10.3f s' % (target, 'startup', startup_seconds[target]))
+
+    for dataset in args.datasets:
+        input_file = os.path.abspath(dataset_path(args.data_dir, dataset, args.reads))
+        for target in args.targets:
+            runs = [run_target(target, input_file, blocks_file) for _ in range(args.repeat)]
+            if None in runs or target not in startup_seconds:
+                print('%s failed on %s' % (target, dataset))
+                results.append({'target': target, 'dataset': dataset, 'failed': True})
+                continue
+
+            seconds, peak_rss, records, failures = min(runs)
+            result = {'target': target, 'dataset': dataset, 'read_pairs': args.reads,
+                      'seconds': round(seconds, 3), 'startup_seconds': round(startup_seconds[target], 3),
+                      'read_pairs_per_second': round(args.reads / seconds, 1),
+                      'peak_rss_mib': round(peak_rss, 1), 'matches': records,
+                      'yield': round(records / args.reads, 4), 'failures': failures}
+            results.append(result)
+            print('%-40s %-8s %10.0f read pairs/s %8.1f MiB  yield %.4f' % (
+                target, dataset, result['read_pairs_per_second'], result['peak_rss_mib'], result['yield']))
+
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+        output.write('\n')
+
+
+def compare_results(baseline, current, tolerance):
+    # Function 4 "compare_results" lists the regressions of the current results against the baseline results:
+    # throughput down or peak memory up by more than tolerance (a fraction), startup time up by more than tolerance
+    # and STARTUP_SLACK, changed yields or failure counts, and targets that fail now (baselines made before the
+    # startup time was measured are only compared on the rest)
+    regressions = []
+    baseline_results = {(result['target'], result['dataset']): result for result in baseline['results']}
+
+    for result in current['results']:
+        key = (result['target'], result['dataset'])
+        before = baseline_results.get(key)
+        if before is None or before.get('failed'):
+            continue
+        name = '%s on %s' % key
+        if result.get('failed'):
+            regressions.append(name + ': failed')
+            continue
+        if before['read_pairs'] != result['read_pairs']:
+            regressions.append(name + ': different dataset size, not comparable')
+            continue
+
+        if result['read_pairs_per_second'] < before['read_pairs_per_second'] * (1 - tolerance):
+            regressions.append('%s: %.0f read pairs/s, was %.0f' % (name, result['read_pairs_per_second'],
+                                                                   before['read_pairs_per_second']))
+        if result['peak_rss_mib'] > before['peak_rss_mib'] * (1 + tolerance):
+            regressions.append('%s: peak memory %.1f MiB, was %.1f MiB' % (name, result['peak_rss_mib'],
+                                                                           before['peak_rss_mib']))
+        if 'startup_seconds' in before and result['startup_seconds'] > max(
+                before['startup_seconds'] * (1 + tolerance), before['startup_seconds'] + STARTUP_SLACK):
+            regressions.append('%s: startup %.3f s, was %.3f s' % (name, result['startup_seconds'],
+                                                                  before['startup_seconds']))
+        if result['matches'] != before['matches'] or result['failures'] != before['failures']:
+            regressions.append('%s: yield %d %s, was %d %s' % (name, result['matches'], result['failures'],
+                                                               before['matches'], before['failures']))
+
+    return regressions
+
+
+def main():
+    # Main function
+    parser = argparse.ArgumentParser(description='Benchmark parseBarcodes decoders on synthetic datasets and '
+                                                 'compare results against a baseline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmarks and write the results as JSON')
+    run_parser.add_argument("-output", help='JSON results file', required=True, metavar='FILE')
+    run_parser.add_argument("--targets", help='scripts to benchmark, as script[:decoder] (default: the current '
+                                              'driver with every decoder)', nargs='+', default=DEFAULT_TARGETS,
+                            metavar='TARGET')
+    run_parser.add_argument("--datasets", help='standard datasets to use (default: all)', nargs='+',
+                            choices=sorted(DATASETS), default=sorted(DATASETS))
+    run_parser.add_argument("--reads", help='read pairs per dataset (default: 100000)', type=int, default=100000,
+                            metavar='N')
+    run_parser.add_argument("--repeat", help='runs per target and dataset, the fastest counts (default: 3)',
+                            type=int, default=3, metavar='N')
+    run_parser.add_argument("--data-dir", help='where the datasets are made and kept (default: benchmark_data)',
+                            default='benchmark_data', metavar='DIR')
+
+    compare_parser = commands.add_parser('compare', help='flag regressions of a results file against a baseline')
+    compare_parser.add_argument("baseline", help='baseline JSON results file')
+    compare_parser.add_argument("current", help='JSON results file to check')
+    compare_parser.add_argument("--tolerance", help='allowed throughput, memory and startup change as a '
+                                                    'fraction (default: 0.1)', type=float, default=0.1,
+                                metavar='FRACTION')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_benchmarks(args)
+        return
+
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        regressions = compare_results(json.load(baseline_file), json.load(current_file), args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if regressions:
+        sys.exit(1)
+    print('No regressions')
+
+
+if __name__ == "__main__":
+    main()
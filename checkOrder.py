@@ -0,0 +1,76 @@
+# checkOrder.py tunes the order of the read 1 rejection checks of the compiled kernel (parseBarcodes --tune-checks).
+# Only checks that give the same failure reason are reordered, in groups (CHECK_GROUPS): the two linker searches
+# (bad_linker), the anchor, post-anchor base and block correction checks (bad_block) and the four quality windows
+# (low_quality). A read rejected by any check of a group is counted under the reason of the group, so any order
+# within a group gives the same results and counts as the fixed order.
+# The first sample_reads reads are sampled with Read1Decoder.sample_checks, which runs every check of a group on
+# every read that reaches the group and measures the time and the rejections of each check. The checks are then
+# sorted by time per rejection (the best order for independent checks), checks that rejected nothing last, and the
+# decoder runs them in that order for all following reads.
+# The sample counts go to the run counts ('check_sampled:<group>', 'check_rejected:<group>:<check>' and
+# 'check_seconds:<group>:<check>') and the metrics report lists the order they give (group_orders).
+
+# every group of checks with the same failure reason, in the fixed order of the kernel (DEFAULT_CHECK_ORDER)
+CHECK_GROUPS = {
+    'linkers': ['linker1', 'linker2'],
+    'blocks': ['anchors', 'post_base', 'bc1', 'bc2', 'bc3'],
+    'quality': ['bc1', 'bc2', 'bc3', 'umi'],
+}
+
+
+def tuned_order(names, rejected, seconds):
+    # Function 1 "tuned_order" sorts the check names by seconds per rejection, checks without rejections last
+    # (by seconds). Ties keep the fixed order.
+    def cost(index):
+        if rejected[index]:
+            return 0, seconds[index] / rejected[index]
+        return 1, seconds[index]
+    return [names[index] for index in sorted(range(len(names)), key=cost)]
+
+
+def sample_counts(reached, rejected, seconds):
+    # Function 2 "sample_counts" turns a Read1Decoder.sample_checks result (reads per group, rejections and
+    # seconds per check in the fixed order) into run count keys
+    counts = {}
+    check = 0
+    for group_reads, (group, names) in zip(reached, CHECK_GROUPS.items()):
+        counts['check_sampled:' + group] = group_reads
+        for name in names:
+            counts['check_rejected:%s:%s' % (group, name)] = rejected[check]
+            counts['check_seconds:%s:%s' % (group, name)] = seconds[check]
+            check += 1
+    return counts
+
+
+def group_orders(counts):
+    # Function 3 "group_orders" gives the tuned order of the check names of every group from the sample counts
+    return {group: tuned_order(names, [counts.get('check_rejected:%s:%s' % (group, name), 0) for name in names],
+                               [counts.get('check_seconds:%s:%s' % (group, name), 0.0) for name in names])
+            for group, names in CHECK_GROUPS.items()}
+
+
+class CheckTuner:
+    # Samples the first sample_reads reads decoded by this process, then sets the tuned order on the decoder
+    # (Read1Decoder.check_order: the check numbers within each group, groups in CHECK_GROUPS order). order is None
+    # until the sample is complete.
+
+    def __init__(self, sample_reads):
+        self.sample_reads = sample_reads
+        self.to_sample = sample_reads
+        self.counts = {}
+        self.order = None
+
+    def tune(self, decoder, counts, seqs=None, quals=None, pairs=None):
+        # samples the reads of one decoding call (seqs and quals, or SamPairs pairs) while the sample is not
+        # complete, and sets the tuned order on decoder before the call decodes them
+        if self.to_sample:
+            sampled = min(self.to_sample, len(pairs) if pairs is not None else len(seqs))
+            for count_key, count in sample_counts(*decoder.sample_checks(seqs, quals, pairs, sampled)).items():
+                self.counts[count_key] = self.counts.get(count_key, 0) + count
+                counts[count_key] += count
+            self.to_sample -= sampled
+            if not self.to_sample:
+                orders = group_orders(self.counts)
+                self.order = [names.index(name) for group, names in CHECK_GROUPS.items() for name in orders[group]]
+        if self.order is not None:
+            decoder.check_order = self.order
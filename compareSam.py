@@ -2,7 +2,8 @@
 import argparse  # command line options
 import sys
 import re
-#import profile
+import functools
+from alignmentIO import is_bam, BamTextReader  # BAM input through pysam
 
 ###
 # Updates
@@ -105,7 +106,10 @@ def create_compare_dictionary(illumina_dict, custom):
     return compare_dict, custom_dict
 
 
-def read_file(file):
+def read_file(file, threads=1):
+    # .bam files are decompressed on threads threads and read as SAM text lines
+    if is_bam(file):
+        return BamTextReader(file, threads=threads)
     try:
         filehandle = open(file, 'r')
     except IOError:
@@ -119,17 +123,33 @@ def main():
     # grab SAM filename/path from command line arguments
     parser = argparse.ArgumentParser(description='')
     required_group = parser.add_argument_group('required arguments')
-    required_group.add_argument("-illumina", help='Illumina SAM file', required=True, metavar='')
-    required_group.add_argument("-custom", help='Custom Pipeline SAM file', required=True, metavar='')
-    required_group.add_argument("-read1", help ='Original read1 fastq file', required=True, metavar='')
-    required_group.add_argument("-output", help='.sam output file', required=True, metavar='')
+    required_group.add_argument("-illumina", help='Illumina SAM or BAM file', required=True, metavar='FILE')
+    required_group.add_argument("-custom", help='Custom Pipeline SAM or BAM file', required=True, metavar='FILE')
+    required_group.add_argument("-read1", help='Original read1 fastq file', required=True, metavar='FILE')
+    required_group.add_argument("-output", help='.sam output file', required=True, metavar='FILE')
+    parser.add_argument("--threads", help='BGZF decompression threads for .bam input (default: 4)', type=int,
+                        default=4, metavar='N')
+    parser.add_argument("--profile", help='profile the run and write PREFIX.prof (cProfile), PREFIX.txt (stats and '
+                                          'peak memory) and PREFIX.collapsed (stacks for flame graphs)',
+                        metavar='PREFIX')
     args = parser.parse_args()
 
+    if args.profile:
+        from runProfiler import profile_run  # cProfile, stack sampler and tracemalloc, only loaded when profiling
+        profile_run(functools.partial(compare_files, args), args.profile)
+    else:
+        compare_files(args)
+
+    return
+
+
+def compare_files(args):
+    # compares the Illumina and custom files given on the command line and writes the report to args.output
     print('Opening Illumina file for reading...')
 
     # Open files early to detect errors immediately
-    illumina = read_file(args.illumina)
-    custom = read_file(args.custom)
+    illumina = read_file(args.illumina, threads=args.threads)
+    custom = read_file(args.custom, threads=args.threads)
     read1 = read_file(args.read1)
 
     illumina_dict, illumina_no_bc_list = create_illumina_dictionary(illumina)
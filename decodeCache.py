@@ -0,0 +1,65 @@
+# decodeCache.py memoizes read 1 decoding for parseBarcodes (--decode-cache). Deep libraries repeat the same read 1
+# sequences (same bead and UMI, PCR duplicates), and decoding one again always gives the same result. The result
+# depends on the sequence and, through the quality filter, only on which quality values are below q-score 10, so
+# a read is cached under its sequence and its low quality mask.
+# An entry holds the cell barcode, the UMI and the count keys the decode added (match or failure reason, phase
+# block, corrected blocks). A hit adds the same counts again, so the counts are those of a run without cache.
+# The cache holds at most max_entries reads. When it is full, a new read replaces the least recently used read
+# ('lru') or the oldest read ('fifo', which skips the reordering on every hit).
+import sys
+from collections import OrderedDict
+
+EVICTION_POLICIES = ['lru', 'fifo']
+
+# bytes.translate table of the low quality mask: quality values below q-score 10 (below '+', ASCII 43) become
+# '0', all others '1'
+LOW_QUALITY_MASK = bytes(b'0'[0] if code < 43 else b'1'[0] for code in range(256))
+
+# approximate bytes of an entry besides its sequence and mask: OrderedDict slot and links, key and entry tuples,
+# cell barcode and UMI strings
+ENTRY_OVERHEAD = 104 + 56 + 72 + 67 + 57
+
+
+class DecodeCache:
+    # Bounded cache of the read 1 decoding results of one correction index. get returns the (cell barcode, UMI,
+    # count keys, size) entry of a key made by key, or None. put adds an entry and returns the change in
+    # memory_bytes, the approximate memory used by the entries, and the number of entries evicted to make room.
+    # reset empties the cache for another correction index and returns the bytes freed.
+
+    def __init__(self, max_entries, eviction='lru'):
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.correction_index = None
+
+    def key(self, seq, qual):
+        # str qualities are encoded first (bytes.translate is much faster than str.translate). Characters other than
+        # ASCII become '?', which is not low quality, as in check_bc_quality.
+        if isinstance(qual, str):
+            qual = qual.encode('ascii', 'replace')
+        return seq, qual.translate(LOW_QUALITY_MASK)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.eviction == 'lru':
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, cell_bc, umi, count_keys):
+        # the mask has the size of the sequence. The count keys are shared strings.
+        added = ENTRY_OVERHEAD + 2 * sys.getsizeof(key[0]) + 8 * len(count_keys)
+        evicted = 0
+        self.entries[key] = (cell_bc, umi, count_keys, added)
+        if len(self.entries) > self.max_entries:
+            added -= self.entries.popitem(last=False)[1][3]
+            evicted = 1
+        self.memory_bytes += added
+        return added, evicted
+
+    def reset(self, correction_index):
+        freed = self.memory_bytes
+        self.entries.clear()
+        self.memory_bytes = 0
+        self.correction_index = correction_index
+        return freed
@@ -0,0 +1,67 @@
+# decoderBackends.py is the registry of the read 1 decoders of parseBarcodes (--decoder) and loads the compiled
+# extension if it can. The backends give identical output:
+# - python: decode_read1, read by read. Always available.
+# - numpy: batchDecoder, whole chunks as array operations. Needs numpy.
+# - cython: the compiled kernel of editDistance.pyx (Read1Decoder). Needs the extension, built ahead of time by
+#   setup.py (python setup.py build_ext --inplace, or pip install .), which needs a C compiler.
+# 'auto' picks the first available backend of BACKEND_PREFERENCE (fastest first in benchmarkDecoders runs).
+# 'calibrate' decodes a sample of the reads with every available backend and keeps the fastest (calibrate).
+# edit_distance and LinkerSearch come from the extension, or from pureEditDistance if it cannot be built, so the
+# python backend runs without a compiler. editDistance is None then. Nothing is compiled at run time and numpy is
+# not imported here, so every launch starts fast.
+import sys
+import time
+
+from batchDecoder import has_numpy, require_numpy
+
+try:
+    import editDistance  # compiled helpers, read 1 kernel (built by setup.py)
+    from editDistance import edit_distance, LinkerSearch
+except ImportError:
+    # the extension is not built (no C compiler at install time)
+    editDistance = None
+    from pureEditDistance import edit_distance, LinkerSearch
+
+BACKENDS = ['python', 'numpy', 'cython']
+BACKEND_PREFERENCE = ['cython', 'numpy', 'python']
+DECODER_CHOICES = ['auto', 'calibrate'] + BACKENDS
+
+# reads decoded by every backend in a calibration
+CALIBRATION_READS = 1000
+
+
+def available_backends():
+    # Function 1 "available_backends" lists the backends that can run here, in BACKENDS order
+    return [backend for backend in BACKENDS if backend == 'python' or backend == 'numpy' and has_numpy() or
+            backend == 'cython' and editDistance is not None]
+
+
+def require_backend(backend):
+    # Function 2 "require_backend" ends the program if backend cannot run here
+    if backend == 'numpy':
+        require_numpy()
+    if backend == 'cython' and editDistance is None:
+        print("The cython decoder requires the compiled editDistance extension (python setup.py build_ext "
+              "--inplace, needs a C compiler). Ending program...")
+        sys.exit()
+
+
+def pick_backend(allowed=BACKENDS):
+    # Function 3 "pick_backend" returns the preferred available backend of allowed ('auto'), or the first of
+    # allowed if none is available (require_backend then ends the program)
+    available = available_backends()
+    return next((backend for backend in BACKEND_PREFERENCE if backend in allowed and backend in available),
+                allowed[0])
+
+
+def calibrate(decode, backends, runs=2):
+    # Function 4 "calibrate" times decode(backend), the decoding of the calibration sample, for every backend.
+    # The best of runs runs counts (the first run of a backend also builds its tables). Returns the fastest
+    # backend and the seconds of every backend.
+    seconds = {}
+    for backend in backends:
+        for _ in range(runs):
+            start = time.perf_counter()
+            decode(backend)
+            seconds[backend] = min(seconds.get(backend, float('inf')), time.perf_counter() - start)
+    return min(backends, key=seconds.get), seconds
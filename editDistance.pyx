@@ -1,18 +1,859 @@
+# cython: language_level=3
 # Cython module for edit_distance function
 # Define types with c/cp-def and convert Python parameters to those of C (test -> a)
-# To increase performance, convert Python string to C bytes. Some type conversion required for Python 3
+# Strings are read character by character at C level (no encode step). Bytes are read directly.
 # Read through length (l) of string and count mismatches (m)
+#
+# Read1Decoder is the compiled decoding kernel: one call decodes a whole read 1 (linker location, phase,
+# anchor and N checks, barcode block correction and the quality filter) with the same rules as decode_read1 in
+# parseBarcodes, and returns the corrected block numbers, the UMI and a failure reason code.
+# Read1Decoder.decode_batch decodes a whole list of reads copied into contiguous byte buffers. The decoding loop
+# runs without the GIL, so slices of the batch are decoded in parallel by a pool of threads that all share the one
+# block lookup table of the decoder. Each slice counts its own reason codes and the counts are merged at the end.
+# The rejection checks run in the order of Read1Decoder.check_order, which can be changed within the groups of
+# checks that give the same failure reason. sample_checks measures every check on a sample of reads (checkOrder).
+#
+# LinkerSearch finds a linker in a read with up to k substitutions (or k edits) by bit-parallel approximate matching
+# (bitap: shift-and with the Wu-Manber extension for errors), from the left or from the right. It replaces the
+# fuzzy regex searches of parseBarcodes, and the decoding kernel locates its linkers with the same scan.
+#
+# SamPairs locates read 1 SEQ/QUAL and the read 2 line of every read pair in a buffer of SAM records with memchr,
+# without splitting the records. Read1Decoder.decode_pairs decodes them where they are in the buffer.
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cpython cimport array
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_GET_SIZE, PyBytes_FromStringAndSize
+from libc.string cimport memchr, memcpy
+
+
+cdef extern from "Python.h":
+    const char* PyUnicode_AsUTF8AndSize(object text, Py_ssize_t* size) except NULL
+
 
 cpdef int edit_distance(test, ref):
-    cdef bytes a = <bytes>test
-    cdef bytes b = <bytes>ref
-    cdef int k, l, m
+    cdef str a_str, b_str
+    cdef bytes a_bytes, b_bytes
+    cdef Py_ssize_t k, l
+    cdef int m
 
     m = 0
-    l = len(a)
+    l = len(test)
+
+    if isinstance(test, str):
+        a_str = <str>test
+        b_str = <str>ref
+        for k in range(l):
+            if a_str[k] != b_str[k]:
+                m += 1
+    else:
+        a_bytes = <bytes>test
+        b_bytes = <bytes>ref
+        for k in range(l):
+            if a_bytes[k] != b_bytes[k]:
+                m += 1
+
+    return m
+
+
+# Failure reason codes returned by Read1Decoder.decode_batch and decode_pairs
+DECODE_MATCH = 0
+DECODE_EMPTY = 1  # no sequence (not counted)
+DECODE_BAD_LINKER = 2
+DECODE_N_BASE = 3  # N base up to the GAC anchor (not counted)
+DECODE_BAD_BLOCK = 4
+DECODE_LOW_QUALITY = 5
+DECODE_FALLBACK = 6  # non-ASCII read or quality length differs from sequence length: use decode_read1
+
+# fixed order of the rejection checks (Read1Decoder.check_order)
+DEFAULT_CHECK_ORDER = [0, 1, 0, 1, 2, 3, 4, 0, 1, 2, 3]
+
+cdef enum:
+    MATCH = 0
+    EMPTY = 1
+    BAD_LINKER = 2
+    N_BASE = 3
+    BAD_BLOCK = 4
+    LOW_QUALITY = 5
+    FALLBACK = 6
+
+cdef enum:
+    BLOCK_LENGTH = 6
+    PHASE_LENGTHS = 6  # phase blocks are 0 to 5 bases long. Longer phase offsets are counted together
+    CORRECTED = 0x4000  # flag on table entries of 6-mers 1 substitution away from their block
+    N_REASONS = 7
+    UMI_LENGTH = 8
+    LINKER_LENGTH = 15
+    BASE_BITS = 3
+    MAX_PATTERN_LENGTH = 63  # bitap states are 64-bit masks with bit 0 for the empty prefix
+    PAIR_FIELDS = 6  # SamPairs offsets per read pair: read 1 SEQ start and end, QUAL start and end, read 2 line
+    # rejection checks of decode_chars, in the groups of checkOrder.CHECK_GROUPS: 2 linker checks from
+    # LINKER_CHECKS, 5 block checks from BLOCK_CHECKS and 4 quality checks from QUALITY_CHECKS
+    LINKER_CHECKS = 0
+    BLOCK_CHECKS = 2
+    QUALITY_CHECKS = 7
+    N_CHECKS = 11
+
+ctypedef unsigned long long bitmask
+
+cdef const unsigned char* LINKER1 = b'TAGCCATCGCATTGC'
+cdef const unsigned char* LINKER2 = b'TACCTCTGAGCTGAA'
+
+
+cdef inline int base_code(unsigned char base) noexcept nogil:
+    # 3-bit code of a base: A, C, G, T, N are 0-4, anything else is 5 (never in the table)
+    if base == b'A':
+        return 0
+    if base == b'C':
+        return 1
+    if base == b'G':
+        return 2
+    if base == b'T':
+        return 3
+    if base == b'N':
+        return 4
+    return 5
+
+
+cdef inline int block_number(const unsigned char* s, const short* table) noexcept nogil:
+    # corrected block number of the 6-mer at s (with the CORRECTED flag if it is not an exact match), or -1
+    cdef int k, code = 0
+    for k in range(BLOCK_LENGTH):
+        code = (code << BASE_BITS) | base_code(s[k])
+    return table[code]
+
+
+cdef Py_ssize_t find_in(const unsigned char* s, Py_ssize_t n, const unsigned char* sub, Py_ssize_t length,
+                        Py_ssize_t start, Py_ssize_t end) noexcept nogil:
+    # str.find(sub, start, end) on the n characters at s
+    cdef Py_ssize_t c, k
+    if end > n:
+        end = n
+    for c in range(start, end - length + 1):
+        for k in range(length):
+            if s[c + k] != sub[k]:
+                break
+        else:
+            return c
+    return -1
+
+
+cdef void bitap_masks(const unsigned char* pattern, int length, bint reverse, bitmask* masks) noexcept nogil:
+    # mask of every byte value: bit i + 1 is set where base i of the pattern (read backwards if reverse) is that
+    # byte. N and anything else but the pattern bases match nothing.
+    cdef int i
+    for i in range(256):
+        masks[i] = 0
+    for i in range(length):
+        masks[pattern[length - 1 - i if reverse else i]] |= (<bitmask>1) << (i + 1)
+
+
+cdef int bitap_scan(const unsigned char* s, Py_ssize_t first, Py_ssize_t count, Py_ssize_t step,
+                    const bitmask* masks, int length, int max_errors, bint edits, bint anchored,
+                    Py_ssize_t* scanned) noexcept nogil:
+    # Scans count bases of s from first on (step 1 to the right, -1 to the left) for the pattern of masks.
+    # states[d] bit i is set when the first i pattern bases match the bases just scanned with at most d errors
+    # (substitutions, or edits). Bit 0, the empty prefix, is set again after every base unless the match must
+    # start at the first base scanned (anchored). Returns the errors of the first full match and writes the number
+    # of bases scanned up to its end to scanned, or returns -1.
+    cdef bitmask states[MAX_PATTERN_LENGTH]
+    cdef bitmask found = (<bitmask>1) << length
+    cdef bitmask full = (found << 1) - 1
+    cdef bitmask start = 0 if anchored else 1
+    cdef bitmask mask, previous, old, state, updated
+    cdef Py_ssize_t i
+    cdef int d
+
+    # before the first base, the first d pattern bases can be deleted with d errors
+    for d in range(max_errors + 1):
+        states[d] = ((<bitmask>1) << (d + 1)) - 1 if edits else 1
+    for i in range(count):
+        mask = masks[s[first + i * step]]
+        previous = states[0]
+        state = ((previous << 1) & mask | start) & full
+        states[0] = state
+        for d in range(1, max_errors + 1):
+            old = states[d]
+            # match, or substitution of the read base
+            updated = (old << 1) & mask | (previous << 1) | start
+            if edits:
+                # insertion of the read base, deletion of a pattern base
+                updated |= previous | (state << 1)
+            previous = old
+            state = updated & full
+            states[d] = state
+        for d in range(max_errors + 1):
+            if states[d] & found:
+                scanned[0] = i + 1
+                return d
+    return -1
+
+
+cdef bitmask LINKER1_MASKS[256]
+cdef bitmask LINKER2_REVERSE_MASKS[256]
+bitap_masks(LINKER1, LINKER_LENGTH, False, LINKER1_MASKS)
+bitap_masks(LINKER2, LINKER_LENGTH, True, LINKER2_REVERSE_MASKS)
+
+
+cdef inline bint low_quality_block(const unsigned char* q, Py_ssize_t qn, Py_ssize_t index) noexcept nogil:
+    # check_bc_quality: any of the 6 quality values from index below 43 (q-score 10). -1 checks nothing.
+    cdef Py_ssize_t k
+    if index < 0:
+        return False
+    for k in range(index, min(index + BLOCK_LENGTH, qn)):
+        if q[k] < 43:
+            return True
+    return False
+
+
+cdef inline bint linker_check(int check, const unsigned char* s, Py_ssize_t n, Py_ssize_t* starts) noexcept nogil:
+    # checkOrder 'linkers' check: leftmost linker 1 (check 0) or rightmost linker 2 (check 1) with up to 1
+    # substitution, as the regex search finds them. Writes the linker start to starts[check].
+    cdef Py_ssize_t scanned = 0
+    if check == 0:
+        if bitap_scan(s, 0, n, 1, LINKER1_MASKS, LINKER_LENGTH, 1, False, False, &scanned) < 0:
+            return False
+        starts[0] = scanned - LINKER_LENGTH
+        return True
+    if bitap_scan(s, n - 1, n, -1, LINKER2_REVERSE_MASKS, LINKER_LENGTH, 1, False, False, &scanned) < 0:
+        return False
+    starts[1] = n - scanned
+    return True
+
+
+cdef inline bint block_check(int check, const unsigned char* s, Py_ssize_t n, Py_ssize_t mod,
+                             Py_ssize_t linker1_end, Py_ssize_t linker2_end, const short* table,
+                             int* blocks) noexcept nogil:
+    # checkOrder 'blocks' check: intact ACG and GAC anchors (0), a base after the GAC anchor (1), bc1, bc2 or bc3
+    # 6 bases long and correctable (2 to 4, block number written to blocks[check - 2]). Every check tests the read
+    # length it needs itself, so that they can run in any order.
+    if check == 0:
+        return linker2_end + 20 <= n and s[linker2_end + 6] == b'A' and s[linker2_end + 7] == b'C' and \
+            s[linker2_end + 8] == b'G' and s[linker2_end + 17] == b'G' and s[linker2_end + 18] == b'A' and \
+            s[linker2_end + 19] == b'C'
+    if check == 1:
+        return linker2_end + 20 < n
+    if check == 2:
+        if mod + BLOCK_LENGTH > n:
+            return False
+        blocks[0] = block_number(s + mod, table)
+        return blocks[0] >= 0
+    if check == 3:
+        if linker2_end - LINKER_LENGTH - linker1_end != BLOCK_LENGTH:
+            return False
+        blocks[1] = block_number(s + linker1_end, table)
+        return blocks[1] >= 0
+    if linker2_end + BLOCK_LENGTH > n:
+        return False
+    blocks[2] = block_number(s + linker2_end, table)
+    return blocks[2] >= 0
+
+
+cdef inline bint quality_check(int check, const unsigned char* s, Py_ssize_t n, const unsigned char* q,
+                               Py_ssize_t qn, Py_ssize_t mod, Py_ssize_t linker1_end,
+                               Py_ssize_t linker2_end) noexcept nogil:
+    # checkOrder 'quality' check: no low quality value in bc1, bc2, bc3 or the UMI (0 to 3). Blocks are located
+    # with str.find, as in demultiplex.
+    if check == 0:
+        return not low_quality_block(q, qn, find_in(s, n, s + mod, BLOCK_LENGTH, 0, 20))
+    if check == 1:
+        return not low_quality_block(q, qn, find_in(s, n, s + linker1_end, BLOCK_LENGTH, 20, 41))
+    if check == 2:
+        return not low_quality_block(q, qn, find_in(s, n, s + linker2_end, BLOCK_LENGTH, 41, 55))
+    return not low_quality_block(q, qn, find_in(s, n, s + linker2_end + 9, UMI_LENGTH, 48, 68))
+
+
+cdef inline bint has_n_base(const unsigned char* s, Py_ssize_t n, Py_ssize_t linker2_end) noexcept nogil:
+    # N base up to the GAC anchor
+    cdef Py_ssize_t i
+    for i in range(min(linker2_end + 20, n)):
+        if s[i] == b'N':
+            return True
+    return False
+
+
+cdef inline Py_ssize_t phase_offset(Py_ssize_t n, Py_ssize_t linker1_start) noexcept nogil:
+    # phase offset is the length of the phase block in front of bc1 (python slice semantics)
+    cdef Py_ssize_t mod = linker1_start - 6
+    if mod < 0:
+        return max(0, n + mod)
+    return min(mod, n)
+
+
+cdef inline bint shifted_linkers(Py_ssize_t linker1_start, Py_ssize_t linker2_start) noexcept nogil:
+    # linkers away from the offsets a phase block puts them at, as linker_key of runMetrics
+    return not (6 <= linker1_start < 6 + PHASE_LENGTHS and
+                linker2_start == linker1_start + LINKER_LENGTH + BLOCK_LENGTH)
+
+
+cdef int decode_chars(const unsigned char* s, Py_ssize_t n, const unsigned char* q, Py_ssize_t qn,
+                      const short* table, const unsigned char* order, int* blocks, Py_ssize_t* umi_start,
+                      int* phase, int* corrected, int* shifted) noexcept nogil:
+    # Decodes the read 1 sequence s (n bases) with quality q (qn values, equal to n). Writes the block numbers of
+    # bc1, bc2 and bc3, the start of the UMI, the phase block length and the corrected blocks (bit k for block
+    # k + 1) for a match, and whether the linkers are away from their fixed offsets for a read with both linkers.
+    # Returns a reason code.
+    # order holds the N_CHECKS rejection checks in the order they run: the linker checks, then the block checks and
+    # the quality checks, each numbered within its group (DEFAULT_CHECK_ORDER is the fixed order). A read fails with
+    # the reason of its group at the first check that rejects it, so the order only changes the time spent.
+    cdef int k
+    cdef Py_ssize_t mod, linker1_end, linker2_end
+    cdef Py_ssize_t starts[2]
+
+    if n == 0:
+        return EMPTY
+
+    for k in range(LINKER_CHECKS, BLOCK_CHECKS):
+        if not linker_check(order[k], s, n, starts):
+            return BAD_LINKER
+    linker1_end = starts[0] + LINKER_LENGTH
+    linker2_end = starts[1] + LINKER_LENGTH
+    shifted[0] = shifted_linkers(starts[0], starts[1])
+
+    # remove reads with an N base up to the GAC anchor
+    if has_n_base(s, n, linker2_end):
+        return N_BASE
+    mod = phase_offset(n, starts[0])
+
+    # ACG and GAC anchors must be intact, there must be a base after the GAC anchor and the barcode blocks must be
+    # 6 bases long and correctable
+    for k in range(BLOCK_CHECKS, QUALITY_CHECKS):
+        if not block_check(order[k], s, n, mod, linker1_end, linker2_end, table, blocks):
+            return BAD_BLOCK
+    corrected[0] = 0
+    for k in range(3):
+        if blocks[k] & CORRECTED:
+            blocks[k] &= ~CORRECTED
+            corrected[0] |= 1 << k
+    phase[0] = <int>mod
+
+    # no low quality barcode bases allowed
+    umi_start[0] = linker2_end + 9
+    for k in range(QUALITY_CHECKS, N_CHECKS):
+        if not quality_check(order[k], s, n, q, qn, mod, linker1_end, linker2_end):
+            return LOW_QUALITY
+
+    return MATCH
+
+
+cdef const unsigned char* text_chars(object text, Py_ssize_t* length) except NULL:
+    # pointer to the characters of a bytes object, or of an ASCII str (no copy, no encode)
+    if isinstance(text, bytes):
+        length[0] = PyBytes_GET_SIZE(text)
+        return <const unsigned char*>PyBytes_AS_STRING(text)
+    return <const unsigned char*>PyUnicode_AsUTF8AndSize(text, length)
+
+
+cdef class LinkerSearch:
+    # Bitap search of one linker (str or bytes, at most 63 bases) with up to max_errors substitutions, or edits if
+    # edits is set. search and search_reverse take a str or bytes read and return (start, end) of the match, or
+    # None. With substitutions only, search gives the leftmost match as regex.search(r"(LINKER){s<=k}") and
+    # search_reverse the rightmost match as regex.search(r"(?r)(LINKER){s<=k}"). With edits, search gives the
+    # match that ends first and search_reverse the match that starts last. Their other end is the nearest one
+    # with the fewest errors possible at that end.
+    cdef readonly bytes linker
+    cdef readonly int max_errors
+    cdef readonly bint edits
+    cdef int length
+    cdef bitmask forward_masks[256]
+    cdef bitmask reverse_masks[256]
+
+    def __init__(self, linker, int max_errors=1, bint edits=False):
+        self.linker = linker.encode() if isinstance(linker, str) else bytes(linker)
+        self.length = len(self.linker)
+        if not 0 < self.length <= MAX_PATTERN_LENGTH or not 0 <= max_errors < self.length:
+            print("Linkers must be 1 to " + str(MAX_PATTERN_LENGTH) + " bases long, with fewer errors allowed than "
+                  "bases. Ending program...")
+            sys.exit()
+        self.max_errors = max_errors
+        self.edits = edits
+        bitap_masks(self.linker, self.length, False, self.forward_masks)
+        bitap_masks(self.linker, self.length, True, self.reverse_masks)
+
+    def __reduce__(self):
+        return LinkerSearch, (self.linker, self.max_errors, self.edits)
+
+    def search(self, read):
+        cdef Py_ssize_t n, end, scanned = 0
+        cdef const unsigned char* s
+        cdef int errors
+        # a non-ASCII character is replaced by ? (one byte), so that positions stay the str indexes
+        if isinstance(read, str) and not read.isascii():
+            read = read.encode('ascii', 'replace')
+        s = text_chars(read, &n)
+        errors = bitap_scan(s, 0, n, 1, self.forward_masks, self.length, self.max_errors, self.edits, False,
+                            &scanned)
+        if errors < 0:
+            return None
+        end = scanned
+        if not self.edits:
+            return end - self.length, end
+        # scan back from the end for the nearest start with as many errors
+        bitap_scan(s, end - 1, end, -1, self.reverse_masks, self.length, errors, True, True, &scanned)
+        return end - scanned, end
+
+    def search_reverse(self, read):
+        cdef Py_ssize_t n, start, scanned = 0
+        cdef const unsigned char* s
+        cdef int errors
+        if isinstance(read, str) and not read.isascii():
+            read = read.encode('ascii', 'replace')
+        s = text_chars(read, &n)
+        errors = bitap_scan(s, n - 1, n, -1, self.reverse_masks, self.length, self.max_errors, self.edits, False,
+                            &scanned)
+        if errors < 0:
+            return None
+        start = n - scanned
+        if not self.edits:
+            return start, start + self.length
+        bitap_scan(s, start, n - start, 1, self.forward_masks, self.length, errors, True, True, &scanned)
+        return start, start + scanned
+
+
+cdef inline bint is_space(unsigned char c) noexcept nogil:
+    # whitespace as in bytes.rstrip
+    return c == b' ' or b'\t' <= c <= b'\r'
+
+
+cdef Py_ssize_t find_sam_fields(const unsigned char* s, Py_ssize_t n, long long* fields) noexcept nogil:
+    # Fills the SamPairs offsets of the n bytes at s (lines of read 1 and read 2 records, alternating). Trailing
+    # whitespace is left out of every line, as line.rstrip() does. Returns the number of the first read 1 line
+    # with fewer than 11 fields, or -1.
+    cdef Py_ssize_t start = 0, end, line = 0, p
+    cdef const unsigned char* found
+    cdef long long* pair
+    cdef int k
+
+    while start < n:
+        found = <const unsigned char*>memchr(s + start, b'\n', n - start)
+        end = found - s if found != NULL else n
+        pair = fields + PAIR_FIELDS * (line // 2)
+        p = end
+        while p > start and is_space(s[p - 1]):
+            p -= 1
+
+        if line % 2:
+            pair[4] = start
+            pair[5] = p
+        else:
+            # SEQ and QUAL are fields 10 and 11, after the 9th and the 10th tab
+            pair[3] = p
+            p = start
+            for k in range(10):
+                found = <const unsigned char*>memchr(s + p, b'\t', pair[3] - p)
+                if found == NULL:
+                    return line
+                p = found - s + 1
+                if k == 8:
+                    pair[0] = p
+            pair[1] = p - 1
+            pair[2] = p
+            found = <const unsigned char*>memchr(s + p, b'\t', pair[3] - p)
+            if found != NULL:
+                pair[3] = found - s
+
+        line += 1
+        start = end + 1
+    return -1
+
+
+cdef class SamPairs:
+    # The read pairs of a buffer of whole SAM records, read 1 and read 2 alternating (parseBarcodes --binary).
+    # Only the fields decoding needs are located, as offsets into the buffer: SEQ and QUAL of read 1 and the read 2
+    # line without its line end. Records are never split into fields, and read 2 is written back from the buffer
+    # as it is, followed by its tags. A last read 1 without its read 2 has -1 as read 2 offsets.
+    # The program ends if a read 1 record has fewer than 11 fields.
+    cdef readonly bytes buffer
+    cdef readonly Py_ssize_t n_pairs
+    cdef array.array fields
+
+    def __init__(self, bytes buffer):
+        cdef const unsigned char* s = <const unsigned char*>PyBytes_AS_STRING(buffer)
+        cdef Py_ssize_t n = PyBytes_GET_SIZE(buffer), bad_line
+        cdef Py_ssize_t n_lines = buffer.count(b'\n') + (1 if n and s[n - 1] != b'\n' else 0)
+
+        self.buffer = buffer
+        self.n_pairs = (n_lines + 1) // 2
+        self.fields = array.array('q', [-1]) * (PAIR_FIELDS * self.n_pairs)
+        with nogil:
+            bad_line = find_sam_fields(s, n, self.fields.data.as_longlongs)
+        if bad_line >= 0:
+            print("SAM record with fewer than 11 fields: " +
+                  buffer.split(b'\n')[bad_line][:100].decode('ascii', 'replace') + ". Ending program...")
+            sys.exit()
+
+    def __len__(self):
+        return self.n_pairs
+
+    def read1(self, Py_ssize_t i):
+        # SEQ and QUAL of read 1 of pair i, as bytes
+        cdef const char* s = PyBytes_AS_STRING(self.buffer)
+        cdef long long* pair = self.fields.data.as_longlongs + PAIR_FIELDS * i
+        return PyBytes_FromStringAndSize(s + pair[0], pair[1] - pair[0]), \
+            PyBytes_FromStringAndSize(s + pair[2], pair[3] - pair[2])
+
+    def read1_fields(self):
+        # SEQ and QUAL of every read 1, as two lists of bytes
+        cdef const char* s = PyBytes_AS_STRING(self.buffer)
+        cdef long long* pair
+        cdef Py_ssize_t i
+        seqs = []
+        quals = []
+        for i in range(self.n_pairs):
+            pair = self.fields.data.as_longlongs + PAIR_FIELDS * i
+            seqs.append(PyBytes_FromStringAndSize(s + pair[0], pair[1] - pair[0]))
+            quals.append(PyBytes_FromStringAndSize(s + pair[2], pair[3] - pair[2]))
+        return seqs, quals
+
+    def tagged_read2s(self, list tags):
+        # The read 2 records of every pair with tags (a bytes suffix per pair, None to leave the pair out), each
+        # copied from the buffer and followed by its suffix, as one bytes object
+        cdef const char* s = PyBytes_AS_STRING(self.buffer)
+        cdef long long* fields = self.fields.data.as_longlongs
+        cdef Py_ssize_t i, size = 0, length
+        cdef char* out
+
+        if len(tags) != self.n_pairs:
+            raise ValueError('one tag suffix per read pair')
+        for i in range(self.n_pairs):
+            if tags[i] is not None and fields[PAIR_FIELDS * i + 4] >= 0:
+                size += fields[PAIR_FIELDS * i + 5] - fields[PAIR_FIELDS * i + 4] + len(<bytes>tags[i])
+
+        output = PyBytes_FromStringAndSize(NULL, size)
+        out = PyBytes_AS_STRING(output)
+        for i in range(self.n_pairs):
+            if tags[i] is not None and fields[PAIR_FIELDS * i + 4] >= 0:
+                length = fields[PAIR_FIELDS * i + 5] - fields[PAIR_FIELDS * i + 4]
+                memcpy(out, s + fields[PAIR_FIELDS * i + 4], length)
+                out += length
+                length = PyBytes_GET_SIZE(tags[i])
+                memcpy(out, PyBytes_AS_STRING(tags[i]), length)
+                out += length
+        return output
+
+
+cdef class Read1Batch:
+    # Reads of one decode_batch call: the sequence of read i is seq_buffer[seq_starts[i]:seq_ends[i]] and its
+    # quality qual_buffer[qual_starts[i]:qual_ends[i]]. Lists of sequences and qualities are copied back to back
+    # into one buffer each. The reads of SamPairs are used in place, in the SAM buffer. Results are written to
+    # reasons, blocks (3 per read) and umi_starts.
+    cdef Read1Decoder decoder
+    cdef bytes seq_buffer, qual_buffer
+    cdef array.array seq_starts, seq_ends, qual_starts, qual_ends, reasons, blocks, umi_starts
+    cdef Py_ssize_t n_reads
+
+    def __init__(self, Read1Decoder decoder, seqs=None, quals=None, SamPairs pairs=None):
+        cdef Py_ssize_t i, seq_start = 0, qual_start = 0
+        cdef long long* fields
+
+        self.decoder = decoder
+        self.n_reads = pairs.n_pairs if pairs is not None else len(seqs)
+        self.seq_starts = array.array('q', [0]) * self.n_reads
+        self.seq_ends = array.array('q', [0]) * self.n_reads
+        self.qual_starts = array.array('q', [0]) * self.n_reads
+        self.qual_ends = array.array('q', [0]) * self.n_reads
+        self.reasons = array.array('i', [-1]) * self.n_reads
+        self.blocks = array.array('i', [-1]) * (3 * self.n_reads)
+        self.umi_starts = array.array('q', [0]) * self.n_reads
+
+        if pairs is not None:
+            fields = pairs.fields.data.as_longlongs
+            for i in range(self.n_reads):
+                self.seq_starts.data.as_longlongs[i] = fields[PAIR_FIELDS * i]
+                self.seq_ends.data.as_longlongs[i] = fields[PAIR_FIELDS * i + 1]
+                self.qual_starts.data.as_longlongs[i] = fields[PAIR_FIELDS * i + 2]
+                self.qual_ends.data.as_longlongs[i] = fields[PAIR_FIELDS * i + 3]
+            self.seq_buffer = pairs.buffer
+            self.qual_buffer = pairs.buffer
+            return
+
+        for i in range(self.n_reads):
+            self.seq_starts.data.as_longlongs[i] = seq_start
+            self.qual_starts.data.as_longlongs[i] = qual_start
+            seq_start += len(seqs[i])
+            qual_start += len(quals[i])
+            self.seq_ends.data.as_longlongs[i] = seq_start
+            self.qual_ends.data.as_longlongs[i] = qual_start
+
+        if self.n_reads and isinstance(seqs[0], bytes):
+            self.seq_buffer = b''.join(seqs)
+            self.qual_buffer = b''.join(quals)
+            return
+
+        seq_text = ''.join(seqs)
+        qual_text = ''.join(quals)
+        # one byte per character. Reads with other than ASCII characters are left to decode_read1
+        if not (seq_text.isascii() and qual_text.isascii()):
+            for i in range(self.n_reads):
+                if not (seqs[i].isascii() and quals[i].isascii()):
+                    self.reasons.data.as_ints[i] = FALLBACK
+        self.seq_buffer = seq_text.encode('ascii', 'replace')
+        self.qual_buffer = qual_text.encode('ascii', 'replace')
+
+    def decode_slice(self, Py_ssize_t start, Py_ssize_t end):
+        # Decodes reads start to end without the GIL. Returns the number of reads per reason code, the number of
+        # matches per phase block length (longer phase offsets last) and per corrected block (bc1, bc2, bc3), and
+        # the number of reads with both linkers at their fixed offsets and elsewhere (LINKER_POSITIONS of runMetrics).
+        cdef const unsigned char* s = <const unsigned char*>PyBytes_AS_STRING(self.seq_buffer)
+        cdef const unsigned char* q = <const unsigned char*>PyBytes_AS_STRING(self.qual_buffer)
+        cdef long long* seq_starts = self.seq_starts.data.as_longlongs
+        cdef long long* seq_ends = self.seq_ends.data.as_longlongs
+        cdef long long* qual_starts = self.qual_starts.data.as_longlongs
+        cdef long long* qual_ends = self.qual_ends.data.as_longlongs
+        cdef int* reasons = self.reasons.data.as_ints
+        cdef int* blocks = self.blocks.data.as_ints
+        cdef long long* umi_starts = self.umi_starts.data.as_longlongs
+        cdef const short* table = self.decoder.table.data.as_shorts
+        cdef const unsigned char* order = self.decoder.order
+        cdef long long counts[N_REASONS]
+        cdef long long phase_counts[PHASE_LENGTHS + 1]
+        cdef long long corrected_counts[3]
+        cdef long long linker_counts[2]
+        cdef Py_ssize_t i, n, qn, umi_start
+        cdef int k, phase, corrected, shifted
+
+        for k in range(N_REASONS):
+            counts[k] = 0
+        for k in range(PHASE_LENGTHS + 1):
+            phase_counts[k] = 0
+        for k in range(3):
+            corrected_counts[k] = 0
+        for k in range(2):
+            linker_counts[k] = 0
+
+        with nogil:
+            for i in range(start, end):
+                if reasons[i] < 0:
+                    n = seq_ends[i] - seq_starts[i]
+                    qn = qual_ends[i] - qual_starts[i]
+                    if n and qn != n:
+                        reasons[i] = FALLBACK
+                    else:
+                        umi_start = 0
+                        reasons[i] = decode_chars(s + seq_starts[i], n, q + qual_starts[i], qn, table, order,
+                                                  blocks + 3 * i, &umi_start, &phase, &corrected, &shifted)
+                        umi_starts[i] = umi_start
+                        if reasons[i] != EMPTY and reasons[i] != BAD_LINKER:
+                            linker_counts[shifted] += 1
+                        if reasons[i] == MATCH:
+                            phase_counts[min(phase, PHASE_LENGTHS)] += 1
+                            for k in range(3):
+                                if corrected & (1 << k):
+                                    corrected_counts[k] += 1
+                counts[reasons[i]] += 1
+
+        return ([counts[k] for k in range(N_REASONS)], [phase_counts[k] for k in range(PHASE_LENGTHS + 1)],
+                [corrected_counts[k] for k in range(3)], [linker_counts[k] for k in range(2)])
+
+    def sample_checks(self, Py_ssize_t end):
+        # Runs every rejection check of a group on each of the first end reads that reaches the group (passes all
+        # checks of the groups before, and the N base check before the block checks), one check at a time over all
+        # those reads. Returns the reads that reach each group, and the rejections and seconds of every check, in
+        # the order of DEFAULT_CHECK_ORDER.
+        cdef const unsigned char* s = <const unsigned char*>PyBytes_AS_STRING(self.seq_buffer)
+        cdef const unsigned char* q = <const unsigned char*>PyBytes_AS_STRING(self.qual_buffer)
+        cdef long long* seq_starts = self.seq_starts.data.as_longlongs
+        cdef long long* seq_ends = self.seq_ends.data.as_longlongs
+        cdef long long* qual_starts = self.qual_starts.data.as_longlongs
+        cdef long long* qual_ends = self.qual_ends.data.as_longlongs
+        cdef const short* table = self.decoder.table.data.as_shorts
+        cdef array.array linker_starts, rejecting, reached
+        cdef long long* starts
+        cdef int* failed
+        cdef int* group
+        cdef long long rejections[N_CHECKS]
+        cdef long long group_reads[3]
+        cdef Py_ssize_t i, n
+        cdef Py_ssize_t found[2]
+        cdef int k, check, first
+        cdef int blocks[3]
+
+        end = min(end, self.n_reads)
+        linker_starts = array.array('q', [0]) * (2 * end)
+        rejecting = array.array('i', [0]) * end
+        reached = array.array('i', [0]) * end
+        starts = linker_starts.data.as_longlongs
+        failed = rejecting.data.as_ints
+        group = reached.data.as_ints
+        seconds = []
+        for k in range(N_CHECKS):
+            rejections[k] = 0
+        # group reached by every read: 1 for the linker checks, 0 if it is decoded without any check
+        for i in range(end):
+            n = seq_ends[i] - seq_starts[i]
+            group[i] = self.reasons.data.as_ints[i] != FALLBACK and n > 0 and qual_ends[i] - qual_starts[i] == n
+
+        for k in range(3):
+            group_reads[k] = 0
+            for i in range(end):
+                if group[i] == k + 1:
+                    group_reads[k] += 1
+            first = (LINKER_CHECKS, BLOCK_CHECKS, QUALITY_CHECKS)[k]
+            for check in range((BLOCK_CHECKS, QUALITY_CHECKS, N_CHECKS)[k] - first):
+                started = time.perf_counter()
+                with nogil:
+                    for i in range(end):
+                        if group[i] != k + 1:
+                            continue
+                        n = seq_ends[i] - seq_starts[i]
+                        if k == 0:
+                            failed[i] = not linker_check(check, s + seq_starts[i], n, found)
+                            starts[2 * i + check] = found[check]
+                        elif k == 1:
+                            failed[i] = not block_check(check, s + seq_starts[i], n, phase_offset(n, starts[2 * i]),
+                                                        starts[2 * i] + LINKER_LENGTH,
+                                                        starts[2 * i + 1] + LINKER_LENGTH, table, blocks)
+                        else:
+                            failed[i] = not quality_check(check, s + seq_starts[i], n, q + qual_starts[i],
+                                                          qual_ends[i] - qual_starts[i],
+                                                          phase_offset(n, starts[2 * i]),
+                                                          starts[2 * i] + LINKER_LENGTH,
+                                                          starts[2 * i + 1] + LINKER_LENGTH)
+                        if failed[i]:
+                            rejections[first + check] += 1
+                            group[i] = -(k + 1)
+                seconds.append(time.perf_counter() - started)
+            # the reads no check of the group rejected go on to the next group
+            for i in range(end):
+                if group[i] == k + 1:
+                    n = seq_ends[i] - seq_starts[i]
+                    if k == 0 and has_n_base(s + seq_starts[i], n, starts[2 * i + 1] + LINKER_LENGTH):
+                        group[i] = 0
+                    else:
+                        group[i] = k + 2
+                elif group[i] == -(k + 1):
+                    group[i] = 0
+
+        return [group_reads[k] for k in range(3)], [rejections[k] for k in range(N_CHECKS)], seconds
+
+
+cdef class Read1Decoder:
+    # Built once from the correction index of parseBarcodes (build_correction_index). blocks lists the reference
+    # blocks in the order of the block numbers returned by decode_batch and decode_pairs.
+    # The decoder owns the pool of threads it decodes with (decode_in_threads). close shuts it down, as does freeing
+    # the decoder.
+    cdef array.array table
+    cdef readonly list blocks
+    cdef object thread_pool
+    cdef int pool_threads
+    cdef unsigned char order[N_CHECKS]
+
+    def __init__(self, correction_index):
+        cdef int code
+        cdef unsigned char base
+
+        self.check_order = DEFAULT_CHECK_ORDER
+        self.blocks = sorted(set(block for block in correction_index.values() if block))
+        block_numbers = {block: number for number, block in enumerate(self.blocks)}
+        self.table = array.array('h', [-1]) * (1 << (BASE_BITS * BLOCK_LENGTH))
+
+        # blocks are str, or bytes to decode bytes reads
+        for barcode_block, block in correction_index.items():
+            if block and len(barcode_block) == BLOCK_LENGTH:
+                code = 0
+                for base in (barcode_block.encode('ascii', 'replace') if isinstance(barcode_block, str)
+                             else barcode_block):
+                    code = (code << BASE_BITS) | base_code(base)
+                self.table.data.as_shorts[code] = block_numbers[block] | \
+                    (0 if barcode_block == block else CORRECTED)
+
+    def __dealloc__(self):
+        if self.thread_pool is not None:
+            self.thread_pool.shutdown(wait=False)
+
+    def close(self):
+        # shuts down the thread pool, once its threads finished their slices. The decoder can still be used: the
+        # next decode call with more than one thread starts a new pool.
+        if self.thread_pool is not None:
+            self.thread_pool.shutdown()
+            self.thread_pool = None
+            self.pool_threads = 0
+
+    @property
+    def check_order(self):
+        # order of the rejection checks, as DEFAULT_CHECK_ORDER (set between decode calls, not during one)
+        return [self.order[k] for k in range(N_CHECKS)]
+
+    @check_order.setter
+    def check_order(self, order):
+        cdef int k
+        groups = (order[LINKER_CHECKS:BLOCK_CHECKS], order[BLOCK_CHECKS:QUALITY_CHECKS],
+                  order[QUALITY_CHECKS:N_CHECKS])
+        if len(order) != N_CHECKS or any(sorted(checks) != list(range(len(checks))) for checks in groups):
+            raise ValueError('check order must order the checks of every group: ' + str(DEFAULT_CHECK_ORDER))
+        for k in range(N_CHECKS):
+            self.order[k] = order[k]
+
+    def sample_checks(self, seqs=None, quals=None, SamPairs pairs=None, Py_ssize_t max_reads=-1):
+        # Read1Batch.sample_checks on the first max_reads reads (all if negative) of seqs and quals, or of pairs
+        cdef Read1Batch batch
+        if pairs is None and max_reads >= 0:
+            seqs = seqs[:max_reads]
+            quals = quals[:max_reads]
+        batch = Read1Batch(self, seqs, quals, pairs)
+        return batch.sample_checks(batch.n_reads if max_reads < 0 else max_reads)
+
+    cdef decode_in_threads(self, Read1Batch batch, int threads):
+        # decodes all reads of batch in slices on threads threads and merges the counts of the slices
+        cdef Py_ssize_t n_reads = batch.n_reads, slice_size
+
+        if threads > 1 and n_reads > threads:
+            if self.pool_threads != threads:
+                self.close()
+                self.thread_pool = ThreadPoolExecutor(max_workers=threads)
+                self.pool_threads = threads
+            slice_size = (n_reads + threads - 1) // threads
+            counts = ([0] * N_REASONS, [0] * (PHASE_LENGTHS + 1), [0] * 3, [0] * 2)
+            for slice_counts in self.thread_pool.map(lambda start: batch.decode_slice(start, min(start + slice_size,
+                                                                                                  n_reads)),
+                                                     range(0, n_reads, slice_size)):
+                counts = tuple([total + count for total, count in zip(merged, counted)]
+                               for merged, counted in zip(counts, slice_counts))
+            return counts
+        return batch.decode_slice(0, n_reads)
+
+    def decode_batch(self, seqs, quals, int threads=1):
+        # Decodes a list of read 1 sequences and the matching quality strings (all str or all bytes), split over
+        # threads threads. Returns the (reason, bc1, bc2, bc3, umi) tuple of every read and the merged counts of
+        # Read1Batch.decode_slice: reads per reason code, matches per phase block length and per corrected block,
+        # reads per linker position.
+        cdef Read1Batch batch = Read1Batch(self, seqs, quals)
+        cdef Py_ssize_t i
+        cdef int* reasons = batch.reasons.data.as_ints
+        cdef int* blocks = batch.blocks.data.as_ints
+        cdef long long umi_start
+
+        counts = self.decode_in_threads(batch, threads)
+        results = []
+        for i in range(batch.n_reads):
+            if reasons[i] == MATCH:
+                umi_start = batch.umi_starts.data.as_longlongs[i]
+                results.append((DECODE_MATCH, blocks[3 * i], blocks[3 * i + 1], blocks[3 * i + 2],
+                                seqs[i][umi_start:umi_start + UMI_LENGTH]))
+            else:
+                results.append((reasons[i], -1, -1, -1, None))
+
+        return results, counts
+
+    def decode_pairs(self, SamPairs pairs, int threads=1):
+        # Decodes read 1 of every pair of a SamPairs buffer in place, as decode_batch. The UMIs are bytes.
+        cdef Read1Batch batch = Read1Batch(self, pairs=pairs)
+        cdef const char* s = PyBytes_AS_STRING(pairs.buffer)
+        cdef Py_ssize_t i
+        cdef int* reasons = batch.reasons.data.as_ints
+        cdef int* blocks = batch.blocks.data.as_ints
+        cdef long long umi_start
 
-    for k from 0 <= k < l:
-        if a[k] != b[k]:
-            m += 1
+        counts = self.decode_in_threads(batch, threads)
+        results = []
+        for i in range(batch.n_reads):
+            if reasons[i] == MATCH:
+                umi_start = batch.seq_starts.data.as_longlongs[i] + batch.umi_starts.data.as_longlongs[i]
+                results.append((DECODE_MATCH, blocks[3 * i], blocks[3 * i + 1], blocks[3 * i + 2],
+                                PyBytes_FromStringAndSize(s + umi_start, min(UMI_LENGTH,
+                                                          batch.seq_ends.data.as_longlongs[i] - umi_start))))
+            else:
+                results.append((reasons[i], -1, -1, -1, None))
 
-    return m
\ No newline at end of file
+        return results, counts
@@ -0,0 +1,93 @@
+# packedBarcodes.py converts cell barcodes and UMIs between strings and packed integers. Integers hash and
+# compare faster than strings and take less memory when reads are counted or grouped by cell or UMI.
+# Two encodings are used:
+# - 2 bits per base (A=0, C=1, G=2, T=3): an 18-mer cell barcode is a 36-bit int, an 8-mer UMI a 16-bit int
+# - block numbers: a cell barcode is the triple of its bc1, bc2 and bc3 positions in the barcode block list
+#   (0-95 each), or the single cell id (bc1 * 96 + bc2) * 96 + bc3, which fits a 32-bit SAM/BAM integer tag
+# Bases other than A, C, G and T have no 2-bit code. The encoders return None for sequences containing them.
+# Sequences may be str or bytes. Block numbers must then have keys of the same type.
+
+# translate tables turning a DNA sequence (str or bytes) into a base 4 number
+BASE4_DIGITS = {str: str.maketrans('ACGT', '0123'), bytes: bytes.maketrans(b'ACGT', b'0123')}
+BASES = 'ACGT'
+
+BLOCK_LENGTH = 6
+
+
+def encode_bases(seq):
+    # Function 1 "encode_bases" packs a DNA sequence into an int with 2 bits per base, first base highest
+    digits = seq.translate(BASE4_DIGITS[type(seq)])
+    # int() would also accept signs, spaces and underscores
+    if not digits.isdigit():
+        return None
+    try:
+        return int(digits, 4)
+    except ValueError:
+        return None
+
+
+def decode_bases(packed, length):
+    # Function 2 "decode_bases" unpacks an int from encode_bases back into a sequence of length bases
+    bases = []
+    for shift in range(2 * (length - 1), -1, -2):
+        bases.append(BASES[(packed >> shift) & 3])
+    return ''.join(bases)
+
+
+def encode_cell_barcode(cell_bc):
+    # Function 3 "encode_cell_barcode" packs an 18-mer cell barcode into a 36-bit int
+    return encode_bases(cell_bc)
+
+
+def decode_cell_barcode(packed):
+    # Function 4 "decode_cell_barcode" unpacks a 36-bit cell barcode from encode_cell_barcode
+    return decode_bases(packed, 3 * BLOCK_LENGTH)
+
+
+def encode_umi(umi):
+    # Function 5 "encode_umi" packs an 8-mer UMI into a 16-bit int
+    return encode_bases(umi)
+
+
+def decode_umi(packed, length=8):
+    # Function 6 "decode_umi" unpacks a UMI from encode_umi
+    return decode_bases(packed, length)
+
+
+def get_block_numbers(ref_barcode_blocks):
+    # Function 7 "get_block_numbers" numbers the reference barcode blocks in the order of the blocks file
+    return {block: number for number, block in enumerate(ref_barcode_blocks)}
+
+
+def cell_barcode_blocks(cell_bc, block_numbers):
+    # Function 8 "cell_barcode_blocks" returns the (bc1, bc2, bc3) block numbers of a corrected cell barcode
+    return (block_numbers[cell_bc[0:BLOCK_LENGTH]],
+            block_numbers[cell_bc[BLOCK_LENGTH:2 * BLOCK_LENGTH]],
+            block_numbers[cell_bc[2 * BLOCK_LENGTH:3 * BLOCK_LENGTH]])
+
+
+def encode_cell_id(cell_bc, block_numbers):
+    # Function 9 "encode_cell_id" turns a corrected cell barcode into its cell id
+    bc1, bc2, bc3 = cell_barcode_blocks(cell_bc, block_numbers)
+    n_blocks = len(block_numbers)
+    return (bc1 * n_blocks + bc2) * n_blocks + bc3
+
+
+def decode_cell_id(cell_id, ref_barcode_blocks):
+    # Function 10 "decode_cell_id" turns a cell id from encode_cell_id back into the cell barcode
+    n_blocks = len(ref_barcode_blocks)
+    bc12, bc3 = divmod(cell_id, n_blocks)
+    bc1, bc2 = divmod(bc12, n_blocks)
+    return ref_barcode_blocks[bc1] + ref_barcode_blocks[bc2] + ref_barcode_blocks[bc3]
+
+
+def packed_id_tags(cell_bc, umi, block_numbers):
+    # Function 11 "packed_id_tags" returns the SAM tags with the integer ids of a read: xc (cell id) and
+    # xm (2-bit packed UMI). The UMI tag is left out if the UMI has a base without a 2-bit code.
+    # Returns bytes for a bytes cell barcode.
+    binary = isinstance(cell_bc, bytes)
+    tags = (b'\txc:i:%d' if binary else '\txc:i:%d') % encode_cell_id(cell_bc, block_numbers)
+    packed_umi = encode_umi(umi)
+    if packed_umi is not None:
+        tags += (b'\txm:i:%d' if binary else '\txm:i:%d') % packed_umi
+    return tags
@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
-import setuptools # needed to build c module in windows (may also need to install c++ build tools)
 import argparse  # command line options
-import regex  # regular expressions with edit distance functions
-import pyximport  # install Cython to access pyximport. Allows faster calculation of edit_distance via C code
-pyximport.install(build_in_temp=False)
-from editDistance import edit_distance
+# compiled helpers and read 1 kernel (editDistance is None without the extension), read 1 decoder registry
+from decoderBackends import editDistance, edit_distance, LinkerSearch
+from decoderBackends import BACKENDS, CALIBRATION_READS, DECODER_CHOICES, available_backends, calibrate
+from decoderBackends import pick_backend, require_backend
 import sys
-import distance
+import functools
+import itertools
+import time
+from collections import Counter, defaultdict, deque  # failure counters and in-flight chunk bookkeeping
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from alignmentIO import is_bam, file_format, open_binary, open_text, split_sam_header, read_line_blocks
+from alignmentIO import BamTextReader, BamTextWriter
+from batchDecoder import decode_read1_batch  # NumPy decoder for whole chunks of read 1
+from batchWriter import BatchWriter, DEFAULT_BUFFER_MIB  # output in large buffered writes
+from checkOrder import CheckTuner  # order of the kernel rejection checks (--tune-checks)
+from decodeCache import DecodeCache, EVICTION_POLICIES  # memoized read 1 decoding (--decode-cache)
+from packedBarcodes import get_block_numbers, packed_id_tags  # integer ids of cell barcodes and UMIs
+from readPipeline import run_pipeline  # reader, decoder and writer stages on threads (--pipeline)
+from runMetrics import add_time, linker_key, phase_key, pipeline_bottleneck, timed, write_report  # --metrics
+from runMetrics import LINKER_POSITIONS  # linker position counts of the compiled kernel
 
 # Updates:
 # ACGGAC must be correctly positioned. There MUST be >=1 base after the anchor
@@ -33,25 +46,88 @@ import distance
 # correct positioning of the read.
 
 
-# Keep track of success and failures
-bad_phase = 0
-bad_block = 0
-low_quality = 0
-bad_linker = 0
-matches = 0
+# Keep track of success and failures: bad_phase, bad_block, low_quality, bad_linker and matches are counted in
+# a Counter handed to every decoding call, so that chunks decoded in separate processes can be merged at the end.
+# bad_phase stays 0: the phase prefix in front of bc1 is never rejected, whatever its length or bases (see
+# decode_linked_read1), so there are no bad or ambiguous phase prefixes. It is still counted and printed as "Bad
+# phases" to keep the counts and the report of the earlier versions.
+# The same Counter holds the run metrics (stage times, phase blocks, corrected blocks), see runMetrics.
+
+# Read 1 structure: phase block (PHASE_BLOCKS), bc1, linker 1, bc2, linker 2, bc3, ACG anchor, UMI, GAC anchor
+LINKER1 = 'TAGCCATCGCATTGC'
+LINKER2 = 'TACCTCTGAGCTGAA'
+# bitap searches of the linkers with up to 1 substitution (no indels)
+LINKER1_SEARCH = LinkerSearch(LINKER1)
+LINKER2_SEARCH = LinkerSearch(LINKER2)
+# searches with up to 1 edit (insertion, deletion or substitution) for the relaxed pass of --rescue, as the fuzzy
+# regex searches (?e)(LINKER){e<=1} of the first versions
+LINKER1_EDIT_SEARCH = LinkerSearch(LINKER1, edits=True)
+LINKER2_EDIT_SEARCH = LinkerSearch(LINKER2, edits=True)
+
+# Records are str, or bytes with --binary (files opened in binary mode, no decoding to str). The decoding functions
+# look up the constants they need by the type of the record.
+TAB = {str: '\t', bytes: b'\t'}
+NEWLINE = {str: '\n', bytes: b'\n'}
+EMPTY = {str: '', bytes: b''}
+N_BASE = {str: 'N', bytes: b'N'}
+ANCHORS = {str: 'ACGGAC', bytes: b'ACGGAC'}
+# quality values below q-score 10 compare lower than these: '+' is ASCII 43, bytes hold the ASCII codes
+LOW_QUALITY_LIMIT = {str: '+', bytes: 43}
+BARCODE_TAGS = {str: '%s\tXC:Z:%s\tXM:Z:%s', bytes: b'%s\tXC:Z:%s\tXM:Z:%s'}
+SAM_READ2 = {str: '%s\t141\t*\t0\t0\t*\t*\t0\t0\t%s\t%s\tXC:Z:%s\tXM:Z:%s%s\n',
+             bytes: b'%s\t141\t*\t0\t0\t*\t*\t0\t0\t%s\t%s\tXC:Z:%s\tXM:Z:%s%s\n'}
+FASTQ_READ2 = {str: '@%s\tXC:Z:%s\tXM:Z:%s%s\n%s\n+\n%s\n', bytes: b'@%s\tXC:Z:%s\tXM:Z:%s%s\n%s\n+\n%s\n'}
+# tags appended to a read 2 record copied from a SamPairs buffer
+READ2_TAGS = b'\tXC:Z:%s\tXM:Z:%s%s\n'
+
+# Correction index of a worker process. Set once per process by init_worker.
+worker_correction_index = None
+
+# Compiled read 1 decoder of the last correction index seen, see get_read1_decoder
+cached_read1_decoder = (None, None)
+
+# Cache of read 1 decoding results of this process (--decode-cache), see set_decode_cache
+read1_cache = None
+
+# Tuning of the kernel rejection check order of this process (--tune-checks), see set_check_tuning
+check_tuner = None
+
+# Relaxed second pass over the rejected reads (--rescue), see set_rescue
+rescue_rejects = False
+
+# Read 1 decoder picked by --decoder calibrate in this process, see calibrate_decoder
+calibrated_decoder = None
+
+# Per-read timing of the linker search, correction and quality check steps of decode_read1 (--metrics only, it
+# costs several timer calls per read), see set_step_timing
+step_timing = False
+
 
 def append_barcode(line, cell_bc, umi):
-    # Function 6 "append_barcode" takes the barcode and adds it to the record as a separate tag
-    line = "%s\t%s\t%s" % (line.rstrip(), 'XC:Z:' + cell_bc, 'XM:Z:' + umi)
+    # Function 6 "append_barcode" takes the barcode and adds it to the record as a separate tag (str or bytes)
+    line = BARCODE_TAGS[type(line)] % (line.rstrip(), cell_bc, umi)
     return line
 
 
+def format_sam_read2(name, seq, qual, cell_bc, umi, extra_tags=None):
+    # Function 6b "format_sam_read2" writes a FASTQ read 2 as an unmapped SAM record (flags as in FastqToSam:
+    # paired, unmapped, mate unmapped, second of pair) with the barcode tags. All fields are str, or all bytes.
+    return SAM_READ2[type(name)] % (name, seq, qual, cell_bc, umi, extra_tags or EMPTY[type(name)])
+
+
+def format_fastq_read2(name, seq, qual, cell_bc, umi, extra_tags=None):
+    # Function 6c "format_fastq_read2" writes a FASTQ read 2 with the barcode tags as a SAM-style comment, which
+    # aligners can copy into the SAM record (bwa mem -C, samtools import -T)
+    return FASTQ_READ2[type(name)] % (name, cell_bc, umi, extra_tags or EMPTY[type(name)], seq, qual)
+
+
 def check_bc_quality(q_seq, bc_index):
     # Function 5 'check_bc_quality' accepts a quality sequence string, a barcode index, and current low
     # quality count. Via the barcode index, the function checks if the corresponding quality string
     # indicates any low quality bases. If any are detected, loq_q_count is incremented by 1.
     # Function 4 is used in function 3 (demultiplexing) and returns the new low_q_count.
     low_q_count = 0
+    low_quality_limit = LOW_QUALITY_LIMIT[type(q_seq)]
 
     for element in q_seq[bc_index:bc_index + 6]:
         # Break out of loop immediately if low_q_count threshold has been passed
@@ -59,82 +135,50 @@ def check_bc_quality(q_seq, bc_index):
             break
 
         # Check the ASCII code if the base quality is low (q-score 10 = ASCII score 43)
-        if ord(element) < 43:
+        if element < low_quality_limit:
             low_q_count += 1
 
     return low_q_count
 
 
-def correct_bc_blocks(ref_barcode_blocks, barcode_block):
-    # Function 4 "correct_bc_blocks" takes each barcode_block from a sequence, checks the hamming distances
-    # between the variable block and all 96 possible blocks, and makes corrections depending on the smallest
-    # ED(edit distance) found. Barcode block is unchanged if smallest ED is 2.
-
-    # Barcode blocks must be 6 bases long to be valid
-    if len(barcode_block) != 6:
-        barcode_block = None
-        return barcode_block
-
-    # start above acceptable threshold
-    lowest_hamming = 6
-    lh_reference_block = ''
-
-    # end function immediately if barcode block matches list of known barcode blocks
-    if barcode_block in ref_barcode_blocks:
-        return barcode_block
-
-    # determine hamming distances between barcode block and all 96 possible blocks
-    for reference_block in ref_barcode_blocks:
+def correct_bc_blocks(correction_index, barcode_block):
+    # Function 4 "correct_bc_blocks" looks up a barcode_block from a sequence in the correction index built by
+    # build_correction_index. Blocks that match a reference block exactly or are 1 hamming distance from exactly
+    # one reference block return that reference block. Anything else (ED >= 2, ambiguous or not 6 bases long)
+    # returns None and the read is skipped.
+    return correction_index.get(barcode_block)
 
-        # use Cython to rapidly conduct calculation. .pyx script will perform type conversion
-        hamming_dist = (edit_distance(barcode_block, reference_block))
-
-        if hamming_dist < lowest_hamming:
-            lowest_hamming = hamming_dist
-            lh_reference_block = reference_block
-        if lowest_hamming == 1:
-            # print('Fix barcode to the one which is 1 ED apart')
-            return lh_reference_block
-
-    # find the blocks with the smallest hamming distances. If that ED is >1, skip the read
-    barcode_block = None
-
-    return barcode_block
-
-
-def demultiplex(match_obj1, mod, linker1, linker2, ref_barcode_blocks, read1):
-    global bad_phase
-    global bad_block
-    global low_quality
-    global bad_linker
-    global matches
 
+def demultiplex(match_obj1, mod, linker1_end, linker2_start, linker2_end, correction_index, q_seq, counts):
     bc1 = match_obj1[0 + mod:6 + mod]
 
-    bc2 = match_obj1[linker1.end(1): linker2.start(1)]
+    bc2 = match_obj1[linker1_end: linker2_start]
 
-    bc3 = match_obj1[linker2.end(1): linker2.end(1) + 6]
-    ACGGAC = match_obj1[linker2.end(1) + 6:linker2.end(1) + 9] + \
-             match_obj1[linker2.end(1) + 17:linker2.end(1) + 20]
-    postBase = match_obj1[linker2.end(1) + 20:]  # need a base after the GAC anchor
+    bc3 = match_obj1[linker2_end: linker2_end + 6]
+    ACGGAC = match_obj1[linker2_end + 6:linker2_end + 9] + \
+             match_obj1[linker2_end + 17:linker2_end + 20]
+    postBase = match_obj1[linker2_end + 20:]  # need a base after the GAC anchor
 
-    if edit_distance(ACGGAC, 'ACGGAC') > 0:
+    if edit_distance(ACGGAC, ANCHORS[type(ACGGAC)]) > 0:
         # mutations in these two anchors are not tolerated
-        bad_block += 1
+        counts['bad_block'] += 1
         return None, None, None
 
     if not postBase:
-        bad_block += 1
+        counts['bad_block'] += 1
         return None, None, None
 
-    umi = match_obj1[linker2.end(1) + 9:linker2.end(1) + 17]
+    umi = match_obj1[linker2_end + 9:linker2_end + 17]
 
-    bc1_n = correct_bc_blocks(ref_barcode_blocks, bc1)
-    bc2_n = correct_bc_blocks(ref_barcode_blocks, bc2)
+    start = time.perf_counter() if step_timing else 0.0
+    bc1_n = correct_bc_blocks(correction_index, bc1)
+    bc2_n = correct_bc_blocks(correction_index, bc2)
     if bc2_n and bc1_n:
-        bc3_n = correct_bc_blocks(ref_barcode_blocks, bc3)
+        bc3_n = correct_bc_blocks(correction_index, bc3)
     else:
         bc3_n = None
+    if step_timing:
+        start = add_time(counts, 'correction', start)
 
     if bc3_n:
         # for bc1, beginning is at index 0.
@@ -149,75 +193,65 @@ def demultiplex(match_obj1, mod, linker1, linker2, ref_barcode_blocks, read1):
         # count number of low quality bases.
         low_quality_count = 0
         # break the loop and remove the read combo if count is > 1
-        low_quality_count += check_bc_quality(read1[10], bc1_index)
-        low_quality_count += check_bc_quality(read1[10], bc2_index)
-        low_quality_count += check_bc_quality(read1[10], bc3_index)
-        low_quality_count += check_bc_quality(read1[10], umi_index)
+        low_quality_count += check_bc_quality(q_seq, bc1_index)
+        low_quality_count += check_bc_quality(q_seq, bc2_index)
+        low_quality_count += check_bc_quality(q_seq, bc3_index)
+        low_quality_count += check_bc_quality(q_seq, umi_index)
+        if step_timing:
+            add_time(counts, 'quality_check', start)
 
         # No low quality barcode bases allowed
         if low_quality_count == 0:
             cell_bc = bc1_n + bc2_n + bc3_n
-            matches += 1
+            counts['matches'] += 1
+            counts[phase_key(mod)] += 1
+            for block_name, block, corrected_block in (('bc1', bc1, bc1_n), ('bc2', bc2, bc2_n), ('bc3', bc3, bc3_n)):
+                if block != corrected_block:
+                    counts['corrected:' + block_name] += 1
             return match_obj1, cell_bc, umi
 
         else:
-            low_quality += 1
+            counts['low_quality'] += 1
             pass
     else:
-        bad_block += 1
+        counts['bad_block'] += 1
         pass
 
     return None, None, None
 
 
-def extract_barcode(line, ref_barcode_blocks):
-    global bad_phase
-    global bad_linker
+def find_linkers(match_obj1):
+    # Function 3a "find_linkers" locates the leftmost linker 1 and the rightmost linker 2 in read 1 with the bitap
+    # search, leaving room for 1 substitution each.
+    # Returns the start and end of both linkers, or None if either linker is missing.
+    linker1 = LINKER1_SEARCH.search(match_obj1)
+    linker2 = LINKER2_SEARCH.search_reverse(match_obj1)
 
-    # Function 3: "extract_barcode" uses regex to extract barcode blocks and return complete barcodes
-    # split read 1 to extract relevant parameters
-    read1 = line.rstrip().split('\t')
+    if linker1 and linker2:
+        return linker1 + linker2
 
-    # match to where the sequence should be
-    match_obj1 = read1[9]
+    return None
 
-    phase_blocks = ['', 'A','CT','GCA','TGCG','ATCGA']
 
+def decode_read1(match_obj1, q_seq, correction_index, counts):
+    # Function 3c "decode_read1" decodes the read 1 sequence and quality strings (str or bytes) of a SAM or FASTQ
+    # record.
+    # Returns the sequence, the corrected cell barcode and the UMI, or three Nones if the read is dropped.
     if match_obj1:
         # match blocks accordingly with linkers, leaving room for 1 edit distance
         # only keep reads where ACG and GACT anchors are not mutated
         # main unaccounted case is if insertions occur before/after barcode and before ACG
-        linker1 = regex.search(r"(TAGCCATCGCATTGC){s<=1}", match_obj1)
-        linker2 = regex.search(r"(?er)(TACCTCTGAGCTGAA){s<=1}", match_obj1)
-
-        if linker1 and linker2:
-
-            if 'N' in match_obj1[0:linker2.end(1) + 20]:  # remove reads with an N base up to the GAC anchor
-                return None, None, None
-
-            pb = match_obj1[0:linker1.start(1) - 6]
-
-            if pb in phase_blocks:  # same as if ED = 0 between pb and corresponding reference block
-                mod = len(pb)
-                return demultiplex(match_obj1, mod, linker1, linker2, ref_barcode_blocks, read1)
-
-            lowest_dist = 2
-            for phase_block in phase_blocks:
-
-                dist = distance.levenshtein(pb, phase_block)
-
-                if dist < lowest_dist:
-                    lowest_dist = dist
-                    pb_reference = phase_block
+        if step_timing:
+            start = time.perf_counter()
+            linkers = find_linkers(match_obj1)
+            add_time(counts, 'linker_search', start)
+        else:
+            linkers = find_linkers(match_obj1)
 
-            if lowest_dist <= 2:  # ??? Might be too much
-                mod = len(pb)
-                return demultiplex(match_obj1, mod, linker1, linker2, ref_barcode_blocks, read1)
-            else:  # lowest levenshtein distance is > 1
-                bad_phase += 1
-                pass
+        if linkers:
+            return decode_linked_read1(match_obj1, linkers, q_seq, correction_index, counts)
         else:
-            bad_linker += 1
+            counts['bad_linker'] += 1
             pass
     else:
         # print('Did not match to a SAM record')
@@ -230,47 +264,617 @@ def extract_barcode(line, ref_barcode_blocks):
     return match_obj1, cell_bc, umi
 
 
-def read_and_write_sam(all_records, ref_barcode_blocks, output):
+def decode_linked_read1(match_obj1, linkers, q_seq, correction_index, counts):
+    # Function 3m "decode_linked_read1" decodes read 1 from the start and end of both linkers (find_linkers), as
+    # decode_read1 does once the linkers are found
+    linker1_start, linker1_end, linker2_start, linker2_end = linkers
+    counts[linker_key(linker1_start, linker2_start)] += 1
+
+    # remove reads with an N base up to the GAC anchor
+    if N_BASE[type(match_obj1)] in match_obj1[0:linker2_end + 20]:
+        counts['n_base'] += 1
+        return None, None, None
+
+    pb = match_obj1[0:linker1_start - 6]
+
+    # phase offset: bc1 starts right after the prefix. Phase blocks accept indels/substitutions, so no prefix is
+    # rejected (as in the first versions, where every prefix was within the accepted distance of a phase block)
+    mod = len(pb)
+    return demultiplex(match_obj1, mod, linker1_end, linker2_start, linker2_end, correction_index, q_seq, counts)
+
+
+def get_read1_decoder(correction_index):
+    # Function 3d "get_read1_decoder" builds the compiled decoder (with its block lookup table) once per
+    # correction index and reuses it for every following read. The decoder it replaces is closed, which stops its
+    # decoding threads.
+    global cached_read1_decoder
+    if cached_read1_decoder[0] is not correction_index:
+        if cached_read1_decoder[1] is not None:
+            cached_read1_decoder[1].close()
+        cached_read1_decoder = (correction_index, editDistance.Read1Decoder(correction_index))
+    return cached_read1_decoder[1]
+
+
+def count_kernel_reasons(kernel_counts, counts):
+    # Function 3f "count_kernel_reasons" adds the counts of Read1Decoder.decode_batch (reads per reason code,
+    # matches per phase block length and per corrected block, reads per linker position) to the failure counts.
+    # Empty reads are not counted, as in decode_read1. Fallback reads are counted by decode_read1 itself.
+    reason_counts, phase_counts, corrected_counts, linker_counts = kernel_counts
+    counts['matches'] += reason_counts[editDistance.DECODE_MATCH]
+    counts['bad_linker'] += reason_counts[editDistance.DECODE_BAD_LINKER]
+    counts['n_base'] += reason_counts[editDistance.DECODE_N_BASE]
+    counts['bad_block'] += reason_counts[editDistance.DECODE_BAD_BLOCK]
+    counts['low_quality'] += reason_counts[editDistance.DECODE_LOW_QUALITY]
+    counts['kernel_decoded'] += sum(reason_counts) - reason_counts[editDistance.DECODE_EMPTY] - \
+        reason_counts[editDistance.DECODE_FALLBACK]
+    for phase_length, phase_count in enumerate(phase_counts):
+        counts[phase_key(phase_length)] += phase_count
+    for block_name, corrected_count in zip(['bc1', 'bc2', 'bc3'], corrected_counts):
+        counts['corrected:' + block_name] += corrected_count
+    for position, linker_count in zip(LINKER_POSITIONS, linker_counts):
+        counts['linkers:' + position] += linker_count
+
+
+def decode_read1_threaded(seqs, quals, correction_index, counts, threads):
+    # Function 3g "decode_read1_threaded" decodes a list of read 1 sequences and quality strings with the compiled
+    # kernel, split over threads threads that run without the GIL and share one decoder. Returns one
+    # (sequence, cell barcode, UMI) tuple per read, as decode_read1.
+    decoder = get_read1_decoder(correction_index)
+    if check_tuner:
+        check_tuner.tune(decoder, counts, seqs, quals)
+    kernel_results, kernel_counts = decoder.decode_batch(seqs, quals, threads)
+    count_kernel_reasons(kernel_counts, counts)
+
+    blocks = decoder.blocks
+    results = []
+    for seq, qual, (reason, bc1, bc2, bc3, umi) in zip(seqs, quals, kernel_results):
+        if reason == editDistance.DECODE_MATCH:
+            results.append((seq, blocks[bc1] + blocks[bc2] + blocks[bc3], umi))
+        elif reason == editDistance.DECODE_FALLBACK:
+            results.append(decode_read1(seq, qual, correction_index, counts))
+        else:
+            results.append((None, None, None))
+
+    return results
+
+
+def decode_read1_list(seqs, quals, correction_index, counts, decoder='python', decode_threads=1):
+    # Function 3h "decode_read1_list" decodes a list of read 1 sequences and quality strings with the chosen
+    # decoder: 'python' (decode_read1), 'numpy' (batchDecoder, the whole list at once) or 'cython'
+    # (decode_read1_threaded on decode_threads threads). Returns one (sequence, cell barcode, UMI) tuple per read.
+    # 'calibrate' first picks one of them on these reads (calibrate_decoder).
+    # With --rescue, the reads the decoder rejects then go through the relaxed pass (rescue_read1s).
+    if decoder == 'calibrate':
+        decoder = calibrated_decoder or calibrate_decoder(seqs, quals, correction_index, counts, decode_threads)
+    if decoder == 'numpy':
+        results = decode_read1_batch(seqs, quals, correction_index, counts, decode_read1)
+    elif decoder == 'cython':
+        results = decode_read1_threaded(seqs, quals, correction_index, counts, decode_threads)
+    else:
+        results = [decode_read1_cached(seq, qual, correction_index, counts) for seq, qual in zip(seqs, quals)]
+
+    if rescue_rejects:
+        rejected = [i for i, result in enumerate(results) if result[1] is None]
+        rescued = rescue_read1s([seqs[i] for i in rejected], [quals[i] for i in rejected], correction_index, counts)
+        for i, result in zip(rejected, rescued):
+            results[i] = result
+    return results
+
+
+def decode_read1_pairs(pairs, correction_index, counts, threads):
+    # Function 3i "decode_read1_pairs" decodes read 1 of every pair of a SamPairs buffer with the compiled kernel,
+    # in place (no bytes object per field). Returns one (cell barcode, UMI) tuple per pair, or (None, None) for
+    # dropped reads, with the same counts as decode_read1_threaded.
+    decoder = get_read1_decoder(correction_index)
+    if check_tuner:
+        check_tuner.tune(decoder, counts, pairs=pairs)
+    kernel_results, kernel_counts = decoder.decode_pairs(pairs, threads)
+    count_kernel_reasons(kernel_counts, counts)
+
+    blocks = decoder.blocks
+    results = []
+    for i, (reason, bc1, bc2, bc3, umi) in enumerate(kernel_results):
+        if reason == editDistance.DECODE_MATCH:
+            results.append((blocks[bc1] + blocks[bc2] + blocks[bc3], umi))
+        elif reason == editDistance.DECODE_FALLBACK:
+            results.append(decode_read1(*pairs.read1(i), correction_index, counts)[1:])
+        else:
+            results.append((None, None))
+
+    if rescue_rejects:
+        rejected = [i for i, result in enumerate(results) if result[0] is None]
+        read1s = [pairs.read1(i) for i in rejected]
+        for i, result in zip(rejected, rescue_read1s([read1[0] for read1 in read1s], [read1[1] for read1 in read1s],
+                                                     correction_index, counts)):
+            results[i] = result[1:]
+    return results
+
+
+def set_decode_cache(max_entries, eviction='lru'):
+    # Function 3j "set_decode_cache" gives this process a cache of up to max_entries read 1 decoding results
+    # (see decodeCache), or no cache for 0
+    global read1_cache
+    read1_cache = DecodeCache(max_entries, eviction) if max_entries > 0 else None
+
+
+def decode_read1_cached(match_obj1, q_seq, correction_index, counts):
+    # Function 3k "decode_read1_cached" decodes read 1 as decode_read1, through the cache set by set_decode_cache
+    # if there is one. A read with the same sequence and the same low quality positions as a cached read gets the
+    # cached result and adds the same counts. counts also gets the cache lookups, hits and evictions and the change
+    # in cache memory.
+    if read1_cache is None:
+        return decode_read1(match_obj1, q_seq, correction_index, counts)
+    if read1_cache.correction_index is not correction_index:
+        counts['cache_bytes'] -= read1_cache.reset(correction_index)
+
+    key = read1_cache.key(match_obj1, q_seq)
+    counts['cache_lookups'] += 1
+    entry = read1_cache.get(key)
+    if entry is not None:
+        counts['cache_hits'] += 1
+        cell_bc, umi, count_keys, _ = entry
+        for count_key in count_keys:
+            counts[count_key] += 1
+        return (match_obj1 if cell_bc else None), cell_bc, umi
+
+    # the counts of this read alone (a plain dict is much cheaper to make and merge than a Counter)
+    read_counts = defaultdict(int)
+    match_obj1, cell_bc, umi = decode_read1(match_obj1, q_seq, correction_index, read_counts)
+    for count_key, count in read_counts.items():
+        counts[count_key] += count
+    added, evicted = read1_cache.put(key, cell_bc, umi, tuple([count_key for count_key in read_counts
+                                                               if count_key[:5] != 'time:']))
+    counts['cache_bytes'] += added
+    counts['cache_evictions'] += evicted
+    return match_obj1, cell_bc, umi
+
+
+def set_check_tuning(sample_reads):
+    # Function 3l "set_check_tuning" has the compiled kernel of this process reorder its rejection checks after
+    # sampling the first sample_reads reads (see checkOrder), or keep the fixed order for 0
+    global check_tuner
+    check_tuner = CheckTuner(sample_reads) if sample_reads > 0 else None
+
+
+def calibrate_decoder(seqs, quals, correction_index, counts, decode_threads=1):
+    # Function 3p "calibrate_decoder" (--decoder calibrate) decodes the first CALIBRATION_READS reads of seqs and
+    # quals with every available decoder and keeps the fastest for the rest of the run in this process (each
+    # worker process calibrates on its first chunk). counts gets the reads and the seconds of every decoder
+    # ('calibration_seconds:<decoder>') and the decoder picked ('calibration_picked:<decoder>').
+    global calibrated_decoder
+    sample = seqs[:CALIBRATION_READS], quals[:CALIBRATION_READS]
+    calibrated_decoder, seconds = calibrate(
+        lambda decoder: decode_read1_list(*sample, correction_index, Counter(), decoder, decode_threads),
+        available_backends())
+    counts['calibration_reads'] += len(sample[0])
+    for decoder, decoder_seconds in seconds.items():
+        counts['calibration_seconds:' + decoder] += decoder_seconds
+    counts['calibration_picked:' + calibrated_decoder] += 1
+    return calibrated_decoder
+
+
+def set_step_timing(enabled):
+    # Function 3q "set_step_timing" has decode_read1 time its linker search, correction and quality check steps
+    # read by read in this process (for the metrics report)
+    global step_timing
+    step_timing = enabled
+
+
+def set_rescue(enabled):
+    # Function 3n "set_rescue" has this process decode the reads rejected by the decoder again with relaxed rules
+    # (rescue_read1s)
+    global rescue_rejects
+    rescue_rejects = enabled
+
+
+def rescue_read1s(seqs, quals, correction_index, counts):
+    # Function 3o "rescue_read1s" is the relaxed second pass of --rescue over the read 1 sequences and quality
+    # strings the strict pass rejected. Only a read with a linker the strict search (up to 1 substitution) missed
+    # can decode differently, so all others stay rejected. The missing linker is searched again with up to 1 edit
+    # and the read is decoded with it. Returns one (sequence, cell barcode, UMI) tuple per read, as decode_read1.
+    # The counts of the pass are kept apart under 'rescue:<key>' (reads tried, matches, rejections, phase and
+    # corrected blocks), its time under 'time:rescue'.
+    start = time.perf_counter()
+    rescue_counts = defaultdict(int)
+    results = []
+    for seq, qual in zip(seqs, quals):
+        linker1 = LINKER1_SEARCH.search(seq)
+        linker2 = LINKER2_SEARCH.search_reverse(seq)
+        if not seq or linker1 and linker2:
+            results.append((None, None, None))
+            continue
+
+        rescue_counts['reads'] += 1
+        # an intact linker also matches without its last base (first base of linker 2) with 1 edit, so the edit
+        # search only stands in for a strict search that found nothing
+        linker1 = linker1 or LINKER1_EDIT_SEARCH.search(seq)
+        linker2 = linker2 or LINKER2_EDIT_SEARCH.search_reverse(seq)
+        if linker1 and linker2:
+            results.append(decode_linked_read1(seq, linker1 + linker2, qual, correction_index, rescue_counts))
+        else:
+            rescue_counts['bad_linker'] += 1
+            results.append((None, None, None))
+
+    for count_key, count in rescue_counts.items():
+        if count_key[:5] != 'time:':
+            counts['rescue:' + count_key] += count
+    add_time(counts, 'rescue', start)
+    return results
+
+
+def decode_chunk(lines, correction_index, counts, decoder='python', block_numbers=None, decode_threads=1):
+    # Function 2b "decode_chunk" decodes a list of SAM records in which read 1 and read 2 alternate, starting
+    # with read 1 (all str, or all bytes with --binary). Returns the tagged read 2 records as one string (bytes)
+    # so that a chunk is written in a single call.
+    # The read 1 records of the chunk are decoded with decode_read1_list, the given decoder and decode_threads
+    # (threads for 'cython'). Parsing, decoding and writing are timed once per chunk.
+    # With block_numbers, the integer cell id and packed UMI are added as xc/xm tags.
+    barcoded_read2s = []
+    counts['read_pairs'] += (len(lines) + 1) // 2
+    text_type = type(lines[0])
+    if decoder == 'calibrate':
+        decoder = calibrated_decoder or decoder
+
+    # every even line refers to read1 (field 10 is the sequence, field 11 the quality string). Read 1 is not
+    # written to the new SAM file
+    start = time.perf_counter()
+    tab = TAB[text_type]
+    read1s = [line.rstrip().split(tab) for line in lines[0::2]]
+    start = add_time(counts, 'parsing', start)
+    results = decode_read1_list([read1[9] for read1 in read1s], [read1[10] for read1 in read1s],
+                                correction_index, counts, decoder, decode_threads)
+    start = add_time(counts, 'decoding', start)
+
+    # every odd line is read2. Read2 will have its sequence appended by the previous read1 barcode
+    for line, (match_obj1, cell_bc, umi) in zip(lines[1::2], results):
+        if match_obj1:
+            barcoded_read2 = append_barcode(line, cell_bc, umi)
+            if block_numbers:
+                barcoded_read2 += packed_id_tags(cell_bc, umi, block_numbers)
+            barcoded_read2s.append(barcoded_read2 + NEWLINE[text_type])
+    add_time(counts, 'writing', start)
+    return EMPTY[text_type].join(barcoded_read2s)
+
+
+def decode_sam_buffer(buffer, correction_index, counts, decoder='python', block_numbers=None, decode_threads=1):
+    # Function 2m "decode_sam_buffer" decodes a bytes buffer of whole SAM records (read 1 and read 2 alternating,
+    # --binary) as decode_chunk does, without splitting the records: SamPairs finds SEQ and QUAL of read 1 and the
+    # tagged read 2 records are copied from the buffer, followed by their tags. Returns the tagged records as bytes.
+    start = time.perf_counter()
+    pairs = editDistance.SamPairs(buffer)
+    counts['read_pairs'] += len(pairs)
+    start = add_time(counts, 'parsing', start)
+
+    if decoder == 'calibrate':
+        decoder = calibrated_decoder or calibrate_decoder(*pairs.read1_fields(), correction_index, counts,
+                                                          decode_threads)
+    if decoder == 'cython':
+        results = decode_read1_pairs(pairs, correction_index, counts, decode_threads)
+    else:
+        seqs, quals = pairs.read1_fields()
+        start = add_time(counts, 'parsing', start)
+        results = [result[1:] for result in decode_read1_list(seqs, quals, correction_index, counts, decoder)]
+    start = add_time(counts, 'decoding', start)
+
+    tags = [READ2_TAGS % (cell_bc, umi, packed_id_tags(cell_bc, umi, block_numbers) if block_numbers else b'')
+            if cell_bc else None for cell_bc, umi in results]
+    barcoded_read2s = pairs.tagged_read2s(tags)
+    add_time(counts, 'writing', start)
+    return barcoded_read2s
+
+
+def decode_fastq_chunk(read_pairs, correction_index, counts, fastq_output=False, decoder='python',
+                       block_numbers=None, decode_threads=1):
+    # Function 2g "decode_fastq_chunk" decodes a list of FASTQ read pairs from read_fastq_pair_chunks. Returns
+    # the tagged read 2 records as one string (bytes for bytes reads), as unmapped SAM records or as FASTQ records
+    # (fastq_output).
+    # Read 1 is decoded with decode_read1_list, the given decoder and decode_threads.
+    # With block_numbers, the integer cell id and packed UMI are added as xc/xm tags.
+    barcoded_read2s = []
+    format_read2 = format_fastq_read2 if fastq_output else format_sam_read2
+
+    counts['read_pairs'] += len(read_pairs)
+    start = time.perf_counter()
+    results = decode_read1_list([pair[0] for pair in read_pairs], [pair[1] for pair in read_pairs],
+                                correction_index, counts, decoder, decode_threads)
+    start = add_time(counts, 'decoding', start)
+
+    for (_, _, name2, seq2, qual2), (match_obj1, cell_bc, umi) in zip(read_pairs, results):
+        if match_obj1:
+            extra_tags = packed_id_tags(cell_bc, umi, block_numbers) if block_numbers else None
+            barcoded_read2s.append(format_read2(name2, seq2, qual2, cell_bc, umi, extra_tags))
+    add_time(counts, 'writing', start)
+
+    return EMPTY[type(read_pairs[0][2])].join(barcoded_read2s)
+
+
+def init_worker(correction_index, cache_settings=None, check_sample_reads=0, rescue=False, time_steps=False):
+    # Function 2c "init_worker" hands the correction index to a pool process once, instead of pickling it
+    # alongside every chunk. cache_settings (maximum entries, eviction) gives the process its own decode cache.
+    # check_sample_reads has the process tune its own check order on the first reads it decodes. rescue turns on
+    # the relaxed pass over rejected reads. time_steps times the steps of decode_read1 read by read.
+    global worker_correction_index
+    worker_correction_index = correction_index
+    if cache_settings:
+        set_decode_cache(*cache_settings)
+    set_check_tuning(check_sample_reads)
+    set_rescue(rescue)
+    set_step_timing(time_steps)
+
+
+def decode_chunk_in_worker(decode_function, chunk):
+    # Function 2d "decode_chunk_in_worker" runs a chunk decoding function (decode_chunk, decode_fastq_chunk) in a
+    # pool process with a fresh Counter. The Counter is sent back with the output so that the parent process can
+    # merge the failure counts.
+    counts = Counter()
+    return decode_function(chunk, worker_correction_index, counts), counts
+
+
+def read_pair_chunks(sam_records, chunk_size):
+    # Function 2e "read_pair_chunks" groups the records of an open SAM file into lists of chunk_size read pairs.
+    # Chunks always hold an even number of lines so that read 1 and read 2 are never split across chunks.
+    chunk = []
+    for line in sam_records:
+        chunk.append(line)
+        if len(chunk) == 2 * chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_fastq_pair_chunks(read1_fastq, read2_fastq, chunk_size):
+    # Function 2h "read_fastq_pair_chunks" reads two open FASTQ files in lockstep and yields lists of chunk_size
+    # (read 1 sequence, read 1 quality, read 2 name, read 2 sequence, read 2 quality) tuples, bytes for files
+    # opened in binary mode.
+    # The files must list the same reads in the same order. The program ends (with the message on stderr and exit
+    # status 1, so nothing is mixed into an output on stdout) if the read names or read counts disagree.
+    chunk = []
+    while True:
+        header1 = read1_fastq.readline()
+        header2 = read2_fastq.readline()
+        if not header1 or not header2:
+            if header1 or header2:
+                sys.exit("Read 1 and read 2 FASTQ files have a different number of reads. Ending program...")
+            break
+
+        seq1 = read1_fastq.readline().rstrip()
+        read1_fastq.readline()
+        qual1 = read1_fastq.readline().rstrip()
+        seq2 = read2_fastq.readline().rstrip()
+        read2_fastq.readline()
+        qual2 = read2_fastq.readline().rstrip()
+
+        # read name is the first word of the header, without a /1 or /2 suffix
+        name1 = header1[1:].split(None, 1)[0]
+        name2 = header2[1:].split(None, 1)[0]
+        if name1[-2:] in ('/1', b'/1'):
+            name1 = name1[:-2]
+        if name2[-2:] in ('/2', b'/2'):
+            name2 = name2[:-2]
+        if name1 != name2:
+            sys.exit("Read 1 and read 2 FASTQ files are out of sync at " +
+                     (name1.decode('ascii', 'replace') if isinstance(name1, bytes) else name1) + ". Ending program...")
+
+        chunk.append((seq1, qual1, name2, seq2, qual2))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def decode_in_pool(chunks, decode_function, correction_index, workers, ordered):
+    # Function 2f "decode_in_pool" decodes chunks in a pool of worker processes and yields (output, counts)
+    # per chunk. At most 2 chunks per worker are in flight to keep memory bounded on large inputs.
+    # Ordered mode yields chunks in input order (byte-identical to a serial run). Unordered mode yields chunks
+    # as soon as they are finished.
+    max_in_flight = 2 * workers
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(correction_index, read1_cache and (read1_cache.max_entries,
+                                                                          read1_cache.eviction),
+                                       check_tuner.sample_reads if check_tuner else 0, rescue_rejects,
+                                       step_timing)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(decode_chunk_in_worker, decode_function, chunk))
+            if len(pending) < max_in_flight:
+                continue
+
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_and_write_sam(all_records, correction_index, output, workers=1, ordered=True, chunk_size=10000,
+                       threads=1, output_format=None, stats=None, decoder='python', block_numbers=None,
+                       decode_threads=1, metrics=None, binary=False, write_buffer=DEFAULT_BUFFER_MIB << 20,
+                       write_thread=False, pipeline=0):
     # Function 2 "read_and_write_sam" accounts for edit distance while extracting barcodes
     # Includes the correct_bc_blocks function in order to return full barcode
+    # With workers > 1 the read pairs are decoded in chunks by a pool of processes.
+    # Input and output files ending in .bam are read/written as BAM, with BGZF (de)compression on threads threads.
+    # '-' reads SAM from stdin / writes to stdout. The failure counts are written to stats (default: stdout).
+    # decoder selects the read 1 decoder: 'python', 'numpy' (batchDecoder), 'cython' (compiled kernel) or
+    # 'calibrate' (calibrate_decoder). The compiled kernel decodes each chunk with decode_threads threads sharing
+    # one set of tables.
+    # metrics is the file the JSON metrics report (see runMetrics) is written to.
+    # block_numbers (see packedBarcodes) adds the integer cell id and packed UMI of every read as xc/xm tags.
+    # binary reads and writes the records as bytes (correction_index and block_numbers must have bytes keys).
+    # The output is written in buffers of write_buffer characters (bytes), by a background thread with write_thread.
+    # pipeline reads, decodes and writes the chunks in three stages on their own threads, with queues of pipeline
+    # chunks between them (see readPipeline).
+    run_start = time.perf_counter()
+
+    if is_bam(all_records):
+        originalSAM = BamTextReader(all_records, threads=threads, binary=binary)
+        header_lines = originalSAM.header_lines
+        records = originalSAM
+    else:
+        try:
+            originalSAM = open_binary(all_records) if binary else open_text(all_records)
+        except IOError:
+            print("Could not open SAM file for reading. Ending program...")
+            sys.exit()
+
+        # pass every header line through. start the loop once the pointer is on the actual records
+        header_lines, records = split_sam_header(originalSAM)
+
+    # write header lines to new file.
+    barcodedRead2File = open_output(output, output_format, header_lines, threads, binary, write_buffer, write_thread)
+
+    if binary and editDistance:
+        # buffers of whole records, decoded without splitting them into lines and fields (SamPairs)
+        if is_bam(all_records):
+            chunks = (b''.join(chunk) for chunk in read_pair_chunks(records, chunk_size))
+        else:
+            chunks = read_line_blocks(itertools.islice(records, 1), originalSAM, 2 * chunk_size)
+        decode_function = functools.partial(decode_sam_buffer, decoder=decoder, block_numbers=block_numbers,
+                                            decode_threads=decode_threads)
+    else:
+        chunks = read_pair_chunks(records, chunk_size)
+        decode_function = functools.partial(decode_chunk, decoder=decoder, block_numbers=block_numbers,
+                                            decode_threads=decode_threads)
+    counts = decode_and_write(chunks, decode_function, correction_index, barcodedRead2File, workers, ordered,
+                              pipeline)
+
+    originalSAM.close()
+    barcodedRead2File.close()
+    counts['output_writes'] += barcodedRead2File.writes
+    counts['time:output_wait'] += barcodedRead2File.wait_seconds
+    print_counts(counts, stats)
+    if metrics:
+        write_report(counts, time.perf_counter() - run_start, metrics)
+
+    return
 
+
+def read_and_write_fastq(read1_file, read2_file, correction_index, output, workers=1, ordered=True,
+                         chunk_size=10000, threads=1, output_format=None, stats=None, decoder='python',
+                         block_numbers=None, decode_threads=1, metrics=None, binary=False,
+                         write_buffer=DEFAULT_BUFFER_MIB << 20, write_thread=False, pipeline=0):
+    # Function 2i "read_and_write_fastq" decodes read 1 straight from a pair of (gzipped) FASTQ files, without a
+    # FastqToSam conversion first. The tagged read 2 records are written as SAM, BAM or FASTQ depending on
+    # output_format (default: the extension of output). Either FASTQ file may be '-' (stdin).
+    # binary, write_buffer, write_thread and pipeline as in read_and_write_sam.
+    run_start = time.perf_counter()
+    open_input = open_binary if binary else open_text
     try:
-        originalSAM = open(all_records, 'r')
+        read1_fastq = open_input(read1_file)
+        read2_fastq = open_input(read2_file)
     except IOError:
-        print("Could not open SAM file for reading. Ending program...")
-        sys.exit()
+        sys.exit("Could not open FASTQ file for reading. Ending program...")
 
-    barcodedRead2File = open(output, 'w')
+    output_format = output_format or file_format(output)
+    header_lines = [b'@HD\tVN:1.5\tSO:unsorted\n' if binary else '@HD\tVN:1.5\tSO:unsorted\n']
+    barcodedRead2File = open_output(output, output_format, header_lines, threads, binary, write_buffer, write_thread)
 
-    # write first two lines of sam file (header lines) to new file.
-    # start the loop once the pointer is on the actual records
-    barcodedRead2File.write(originalSAM.readline())
-    barcodedRead2File.write(originalSAM.readline())
-    # declare variable to hold one full barcode in one scope higher than the loop
-    # so that the barcode from read1 is 'saved' for appending to read2
+    chunks = read_fastq_pair_chunks(read1_fastq, read2_fastq, chunk_size)
+    decode_function = functools.partial(decode_fastq_chunk, fastq_output=output_format == 'fastq', decoder=decoder,
+                                        block_numbers=block_numbers, decode_threads=decode_threads)
+    counts = decode_and_write(chunks, decode_function, correction_index, barcodedRead2File, workers, ordered,
+                              pipeline)
 
-    # loop through read1 records and apply decoding algorithm
-    for count, line in enumerate(originalSAM, start=0):
+    read1_fastq.close()
+    read2_fastq.close()
+    barcodedRead2File.close()
+    counts['output_writes'] += barcodedRead2File.writes
+    counts['time:output_wait'] += barcodedRead2File.wait_seconds
+    print_counts(counts, stats)
+    if metrics:
+        write_report(counts, time.perf_counter() - run_start, metrics)
 
-        # every even line refers to read1. Decode read1 for barcodes. Do not write read1 to new SAM file
-        if count % 2 == 0:
-            # Make sure that extract_barcode always returns these 3 variables, even if they're empty
-            match_obj1, cell_bc, umi = extract_barcode(line, ref_barcode_blocks)
+    return
 
-        # every odd line is read2. Read2 will have its sequence appended by the previous read1 barcode
-        if count % 2 == 1 and match_obj1:
 
-            barcodedRead2 = append_barcode(line, cell_bc, umi)
-            barcodedRead2File.write(barcodedRead2 + '\n')
+def open_output(output, output_format, header_lines, threads, binary=False, write_buffer=DEFAULT_BUFFER_MIB << 20,
+                write_thread=False):
+    # Function 2j "open_output" opens the file (or '-' for stdout) for the tagged read 2 records: 'bam', 'fastq'
+    # (header_lines are not written) or 'sam'. A missing output_format is taken from the extension of output.
+    # binary opens SAM and FASTQ files for bytes records (and bytes header_lines).
+    # Returns a BatchWriter, which writes the records in buffers of write_buffer characters (bytes), on a
+    # background thread with write_thread.
+    output_format = output_format or file_format(output)
+    if output_format == 'bam':
+        return BatchWriter(BamTextWriter(output, header_lines, threads=threads), write_buffer, write_thread)
+
+    barcodedRead2File = open_binary(output, 'w') if binary else open_text(output, 'w')
+    if output_format != 'fastq':
+        barcodedRead2File.write(EMPTY[bytes if binary else str].join(header_lines))
+    return BatchWriter(barcodedRead2File, write_buffer, write_thread)
+
+
+def decode_and_write(chunks, decode_function, correction_index, barcodedRead2File, workers, ordered, pipeline=0):
+    # Function 2k "decode_and_write" decodes chunks with decode_function, in this process or in a pool of
+    # workers, and writes each decoded chunk to barcodedRead2File. Returns the merged failure counts.
+    # Reading the chunks counts as parsing time, writing them as writing time.
+    # pipeline reads and writes the chunks on their own threads, through queues of pipeline chunks (readPipeline).
+    counts = Counter()
+
+    def decode_chunks(chunks_to_decode):
+        if workers > 1:
+            for barcoded_read2s, chunk_counts in decode_in_pool(chunks_to_decode, decode_function, correction_index,
+                                                                workers, ordered):
+                counts.update(chunk_counts)
+                yield barcoded_read2s
+        else:
+            # loop through read1 records and apply decoding algorithm
+            for chunk in chunks_to_decode:
+                yield decode_function(chunk, correction_index, counts)
 
-    originalSAM.close()
-    barcodedRead2File.close()
-    print("Bad phases: " + str(bad_phase))
-    print("Bad blocks: " + str(bad_block))
-    print("Low quality blocks: " + str(low_quality))
-    print("Bad linkers: " + str(bad_linker))
+    def write_chunk(barcoded_read2s, write_counts):
+        start = time.perf_counter()
+        barcodedRead2File.write(barcoded_read2s)
+        add_time(write_counts, 'writing', start)
 
-    return
+    if pipeline:
+        run_pipeline(chunks, decode_chunks, write_chunk, counts, pipeline)
+    else:
+        for barcoded_read2s in decode_chunks(timed(chunks, counts, 'parsing')):
+            write_chunk(barcoded_read2s, counts)
+
+    return counts
+
+
+def print_counts(counts, stats=None):
+    # Function 2l "print_counts" reports the failure counts of a run to stats (an open file, default: stdout)
+    stats = stats or sys.stdout
+    stats.write("Bad phases: " + str(counts['bad_phase']) + "\n")
+    stats.write("Bad blocks: " + str(counts['bad_block']) + "\n")
+    stats.write("Low quality blocks: " + str(counts['low_quality']) + "\n")
+    stats.write("Bad linkers: " + str(counts['bad_linker']) + "\n")
+    if counts['batch_decoded']:
+        stats.write("Reads decoded in NumPy batches: " + str(counts['batch_decoded']) + "\n")
+    if counts['kernel_decoded']:
+        stats.write("Reads decoded by the compiled kernel: " + str(counts['kernel_decoded']) + "\n")
+    if counts['calibration_reads']:
+        stats.write("Calibrated decoder: %s (%s per read on %d reads)\n" % (
+            ', '.join(decoder for decoder in BACKENDS if counts['calibration_picked:' + decoder]),
+            ', '.join('%s %.2f us' % (decoder, 1e6 * counts['calibration_seconds:' + decoder] /
+                                      counts['calibration_reads'])
+                      for decoder in BACKENDS if counts['calibration_seconds:' + decoder]),
+            counts['calibration_reads']))
+    if counts['rescue:reads']:
+        stats.write("Rescued by the relaxed pass: %d of %d reads with a missing linker (+%.2f%% yield)\n" % (
+            counts['rescue:matches'], counts['rescue:reads'],
+            100.0 * counts['rescue:matches'] / counts['read_pairs'] if counts['read_pairs'] else 0.0))
+    if counts['pipeline:capacity']:
+        stats.write("Pipeline bottleneck: %s (stalls: reader %.2f s, decoder %.2f s waiting for input and %.2f s "
+                    "for output, writer %.2f s)\n" % (pipeline_bottleneck(counts), counts['time:stall:reader'],
+                                                     counts['time:stall:decoder_input'],
+                                                     counts['time:stall:decoder_output'], counts['time:stall:writer']))
+    if counts['cache_lookups']:
+        stats.write("Decode cache hits: %d of %d (%.1f%%), %.1f MiB in use\n" % (
+            counts['cache_hits'], counts['cache_lookups'], 100.0 * counts['cache_hits'] / counts['cache_lookups'],
+            counts['cache_bytes'] / (1 << 20)))
 
 
 def get_ref_barcode_blocks(barcode_blocks_file):
@@ -283,23 +887,188 @@ def get_ref_barcode_blocks(barcode_blocks_file):
         return ref_barcode_blocks
 
 
+def hamming_neighbors(sequence):
+    # Function 1a "hamming_neighbors" returns every sequence 1 substitution (A, C, G, T or N) away from sequence
+    neighbors = []
+    for i in range(len(sequence)):
+        for base in 'ACGTN':
+            if base != sequence[i]:
+                neighbors.append(sequence[:i] + base + sequence[i + 1:])
+    return neighbors
+
+
+def build_correction_index(ref_barcode_blocks):
+    # Function 1b "build_correction_index" enumerates every 6-mer within 1 hamming distance of the reference
+    # barcode blocks and maps it to its corrected block. Built once at startup so that correct_bc_blocks is a
+    # single dictionary lookup instead of a scan of all 96 blocks per barcode.
+    # 6-mers that are 1 ED from two different reference blocks cannot be corrected reliably. They are flagged
+    # in the index with a value of None (the old first-match loop silently picked whichever block came first).
+    correction_index = {}
+
+    for reference_block in ref_barcode_blocks:
+        for neighbor in hamming_neighbors(reference_block):
+            # a second, different reference block one mismatch away makes the neighbor ambiguous
+            if neighbor in correction_index and correction_index[neighbor] != reference_block:
+                correction_index[neighbor] = None
+            else:
+                correction_index[neighbor] = reference_block
+
+    # exact matches always win over (possibly ambiguous) corrections
+    for reference_block in ref_barcode_blocks:
+        correction_index[reference_block] = reference_block
+
+    return correction_index
+
+
+def encode_correction_index(correction_index):
+    # Function 1e "encode_correction_index" returns the correction index with bytes keys and blocks, to decode
+    # bytes reads (--binary)
+    return {barcode_block.encode(): block.encode() if block else block
+            for barcode_block, block in correction_index.items()}
+
+
 def main():
     # Main function
     # grab SAM filename/path from command line arguments
-    parser = argparse.ArgumentParser(description='Process paired reads from SAM file by extracting '
+    parser = argparse.ArgumentParser(description='Process paired reads from SAM/BAM or FASTQ files by extracting '
                                                  'barcodes from read 1 and tagging them onto read 2. '
                                                  'Read 1 is removed. Result is an unmapped, unpaired '
                                                  'SAM file.')
     required_group = parser.add_argument_group('required arguments')
-    required_group.add_argument("-blocks", help='file containing barcode blocks', required=True, metavar='')
-    required_group.add_argument("-input", help='.sam input file', required=True, metavar='')
-    required_group.add_argument("-output", help='.sam output file', required=True, metavar='')
+    required_group.add_argument("-blocks", help='file containing barcode blocks', required=True, metavar='FILE')
+    required_group.add_argument("-output", help='.sam or .bam output file (.fastq or .fastq.gz with -read1/-read2), '
+                                                '- for stdout',
+                                required=True, metavar='FILE')
+    input_group = parser.add_argument_group('input (either -input or -read1 and -read2)')
+    input_group.add_argument("-input", help='.sam or .bam input file, - for SAM from stdin', metavar='FILE')
+    input_group.add_argument("-read1", help='read 1 .fastq or .fastq.gz file (- for stdin)', metavar='FILE')
+    input_group.add_argument("-read2", help='read 2 .fastq or .fastq.gz file (- for stdin)', metavar='FILE')
+    parser.add_argument("--workers", help='number of decoding processes (default: 1)', type=int, default=1,
+                        metavar='N')
+    parser.add_argument("--unordered", help='with --workers, write chunks as they finish instead of in input '
+                                            'order', action='store_true')
+    parser.add_argument("--chunk-size", help='read pairs per chunk handed to a worker (default: 10000)',
+                        type=int, default=10000, metavar='N')
+    parser.add_argument("--threads", help='BGZF compression threads for .bam input/output (default: 4)', type=int,
+                        default=4, metavar='N')
+    parser.add_argument("--output-format", help='format of the output: sam, bam or fastq (default: from the '
+                                                'extension of -output, sam for -)', choices=['sam', 'bam', 'fastq'])
+    parser.add_argument("--stats", help='write the failure counts to this file instead of stdout (stderr when '
+                                        '-output is -)', metavar='FILE')
+    parser.add_argument("--decoder", help='read 1 decoder: python, numpy (batches of --chunk-size reads, requires '
+                                          'numpy), cython (compiled kernel), auto (the fastest available) or '
+                                          'calibrate (the fastest on the first reads) (default: auto)',
+                        choices=DECODER_CHOICES, default='auto')
+    parser.add_argument("--decode-threads", help='with --decoder cython, decode every chunk with N threads in one '
+                                                 'process (default: 1)', type=int, default=1, metavar='N')
+    parser.add_argument("--metrics", help='write a JSON report of the run (rejections per reason, phase blocks, '
+                                          'corrected blocks, reads/sec, time per stage) to this file',
+                        metavar='FILE')
+    parser.add_argument("--packed-ids", help='also tag reads with the integer cell id (xc:i, block numbers '
+                                             'bc1*96*96 + bc2*96 + bc3) and the 2-bit packed UMI (xm:i)',
+                        action='store_true')
+    parser.add_argument("--binary", help='read and write SAM and FASTQ files in binary mode and decode the records '
+                                         'as bytes, without decoding them to str', action='store_true')
+    parser.add_argument("--decode-cache", help='with --decoder python, keep the decoding results of up to N read 1 '
+                                               'sequences and reuse them for repeated reads (default: 0, no cache)',
+                        type=int, default=0, metavar='N')
+    parser.add_argument("--cache-eviction", help='read replaced when the decode cache is full: lru (least recently '
+                                                 'used) or fifo (oldest) (default: lru)', choices=EVICTION_POLICIES,
+                        default='lru')
+    parser.add_argument("--tune-checks", help='with --decoder cython, sample the rejection checks on the first N '
+                                              'reads (per process) and run them in the order that rejects reads '
+                                              'fastest (default: 0, fixed order)', type=int, default=0,
+                        metavar='N')
+    parser.add_argument("--rescue", help='decode the reads rejected for a missing linker again, with linkers '
+                                         'allowed 1 insertion, deletion or substitution', action='store_true')
+    parser.add_argument("--write-buffer", help='collect the output in buffers of this many MiB, each written with '
+                                               'one call (default: %d)' % DEFAULT_BUFFER_MIB, type=float,
+                        default=DEFAULT_BUFFER_MIB, metavar='N')
+    parser.add_argument("--write-thread", help='write the output buffers on a background thread while decoding goes '
+                                               'on', action='store_true')
+    parser.add_argument("--pipeline", help='read, decode and write on separate threads, with queues of up to N '
+                                           'chunks between them (default: 0, one loop)', type=int, default=0,
+                        metavar='N')
+    parser.add_argument("--profile", help='profile the run and write PREFIX.prof (cProfile), PREFIX.txt (stats and '
+                                          'peak memory) and PREFIX.collapsed (stacks for flame graphs)',
+                        metavar='PREFIX')
     args = parser.parse_args()
+
+    fastq_input = args.read1 or args.read2
+    if fastq_input and (args.input or not (args.read1 and args.read2)):
+        parser.error('give either -input, or both -read1 and -read2')
+    if not fastq_input and not args.input:
+        parser.error('one of -input or -read1/-read2 is required')
+    output_format = args.output_format or file_format(args.output)
+    if args.input and output_format == 'fastq':
+        parser.error('FASTQ output needs -read1/-read2 input')
+    if args.read1 == '-' and args.read2 == '-':
+        parser.error('only one of -read1 and -read2 can be read from stdin')
+
+    if args.decoder == 'auto':
+        args.decoder = pick_backend(['python'] if args.decode_cache else ['cython'] if args.tune_checks else BACKENDS)
+    require_backend(args.decoder)
+    if args.decode_cache and args.decoder != 'python':
+        parser.error('--decode-cache works with --decoder python')
+    if args.tune_checks and args.decoder != 'cython':
+        parser.error('--tune-checks works with --decoder cython')
+    if args.write_buffer < 0:
+        parser.error('--write-buffer must not be negative')
+    if args.pipeline < 0:
+        parser.error('--pipeline must not be negative')
+
+    if args.profile:
+        from runProfiler import profile_run  # cProfile, stack sampler and tracemalloc, only loaded when profiling
+        profile_run(functools.partial(decode_files, args, fastq_input, output_format), args.profile)
+    else:
+        decode_files(args, fastq_input, output_format)
+
+    return
+
+
+def decode_files(args, fastq_input, output_format):
+    # Function 7 "decode_files" runs the decoding for the command line arguments checked by main
+    # keep the failure counts out of the output stream when writing to stdout
+    if args.stats:
+        stats = open(args.stats, 'w')
+    elif args.output == '-':
+        stats = sys.stderr
+    else:
+        stats = sys.stdout
+
     # obtain all possible barcode block combinations
     ref_barcode_blocks = get_ref_barcode_blocks(barcode_blocks_file=args.blocks)
+    correction_index = build_correction_index(ref_barcode_blocks)
+    if args.binary:
+        # bytes reads are looked up with bytes blocks
+        correction_index = encode_correction_index(correction_index)
+        ref_barcode_blocks = [block.encode() for block in ref_barcode_blocks]
+    block_numbers = get_block_numbers(ref_barcode_blocks) if args.packed_ids else None
+    set_decode_cache(args.decode_cache, args.cache_eviction)
+    set_check_tuning(args.tune_checks)
+    set_rescue(args.rescue)
+    set_step_timing(bool(args.metrics))
 
     # construct full cell barcodes from every sequence record. Supply the records in SAM format
-    read_and_write_sam(all_records=args.input, ref_barcode_blocks=ref_barcode_blocks, output=args.output)
+    # or as a pair of FASTQ files
+    if fastq_input:
+        read_and_write_fastq(read1_file=args.read1, read2_file=args.read2, correction_index=correction_index,
+                             output=args.output, workers=args.workers, ordered=not args.unordered,
+                             chunk_size=args.chunk_size, threads=args.threads, output_format=output_format,
+                             stats=stats, decoder=args.decoder, block_numbers=block_numbers,
+                             decode_threads=args.decode_threads, metrics=args.metrics, binary=args.binary,
+                             write_buffer=int(args.write_buffer * (1 << 20)), write_thread=args.write_thread,
+                             pipeline=args.pipeline)
+    else:
+        read_and_write_sam(all_records=args.input, correction_index=correction_index, output=args.output,
+                           workers=args.workers, ordered=not args.unordered, chunk_size=args.chunk_size,
+                           threads=args.threads, output_format=output_format, stats=stats, decoder=args.decoder,
+                           block_numbers=block_numbers, decode_threads=args.decode_threads, metrics=args.metrics,
+                           binary=args.binary, write_buffer=int(args.write_buffer * (1 << 20)),
+                           write_thread=args.write_thread, pipeline=args.pipeline)
+
+    if args.stats:
+        stats.close()
 
     return
 
@@ -1,6 +1,4 @@
-import pyximport  # install Cython to access pyximport
-pyximport.install(build_in_temp=False)
-from editDistance import edit_distance
+from editDistance import edit_distance  # built by setup.py (python setup.py build_ext --inplace)
 import distance
 
 
@@ -0,0 +1,119 @@
+# pureEditDistance.py holds pure Python versions of edit_distance and LinkerSearch of editDistance.pyx, with the
+# same results, for the python decoder of parseBarcodes when the compiled extension cannot be built (no Cython or
+# no C compiler, see decoderBackends). Reads are str or bytes.
+# LinkerSearch finds a linker with up to k substitutions by splitting the linker into k + 1 pieces: one of them
+# matches exactly, so str.find of the pieces gives every possible start and only those starts are compared base
+# by base. Searches that allow edits (indels, only the relaxed pass of --rescue) run the bitap scan of
+# editDistance.pyx on Python integers.
+import sys
+
+MAX_PATTERN_LENGTH = 63
+
+
+def edit_distance(test, ref):
+    # Function 1 "edit_distance" counts the mismatches of test and ref over the length of test
+    return sum(1 for test_base, ref_base in zip(test, ref) if test_base != ref_base)
+
+
+def bitap_masks(pattern, reverse):
+    # Function 2 "bitap_masks" gives the mask of every base of pattern (read backwards if reverse), bit i + 1 set
+    # where base i is that base, keyed by the character (str reads) and by its code (bytes reads)
+    masks = {}
+    for i, base in enumerate(reversed(pattern) if reverse else pattern):
+        masks[base] = masks.get(base, 0) | 1 << (i + 1)
+    masks.update({ord(base): mask for base, mask in masks.items()})
+    return masks
+
+
+def bitap_scan(read, first, count, step, masks, length, max_errors, edits, anchored):
+    # Function 3 "bitap_scan" is bitap_scan of editDistance.pyx: scans count bases of read from first on (step 1
+    # to the right, -1 to the left). Returns the errors of the first full match and the number of bases scanned up
+    # to its end, or (-1, 0).
+    found = 1 << length
+    full = (found << 1) - 1
+    start = 0 if anchored else 1
+    states = [(1 << (d + 1)) - 1 if edits else 1 for d in range(max_errors + 1)]
+    for i in range(count):
+        mask = masks.get(read[first + i * step], 0)
+        previous = states[0]
+        state = ((previous << 1) & mask | start) & full
+        states[0] = state
+        for d in range(1, max_errors + 1):
+            old = states[d]
+            updated = (old << 1) & mask | (previous << 1) | start
+            if edits:
+                updated |= previous | (state << 1)
+            previous = old
+            state = updated & full
+            states[d] = state
+        for d in range(max_errors + 1):
+            if states[d] & found:
+                return d, i + 1
+    return -1, 0
+
+
+class LinkerSearch:
+    # Same searches as LinkerSearch of editDistance.pyx: search gives the leftmost match and search_reverse the
+    # rightmost match of the linker with up to max_errors substitutions, as (start, end), or None. With edits,
+    # search gives the match that ends first and search_reverse the match that starts last.
+
+    def __init__(self, linker, max_errors=1, edits=False):
+        self.linker = linker.encode() if isinstance(linker, str) else bytes(linker)
+        self.length = len(self.linker)
+        if not 0 < self.length <= MAX_PATTERN_LENGTH or not 0 <= max_errors < self.length:
+            print("Linkers must be 1 to " + str(MAX_PATTERN_LENGTH) + " bases long, with fewer errors allowed than "
+                  "bases. Ending program...")
+            sys.exit()
+        self.max_errors = max_errors
+        self.edits = edits
+        self.linkers = {bytes: self.linker, str: self.linker.decode('ascii')}
+        # piece bounds: max_errors + 1 pieces of (almost) the same length
+        bounds = [self.length * piece // (max_errors + 1) for piece in range(max_errors + 2)]
+        self.pieces = list(zip(bounds, bounds[1:]))
+        self.forward_masks = bitap_masks(self.linkers[str], False)
+        self.reverse_masks = bitap_masks(self.linkers[str], True)
+
+    def substitution_start(self, read, reverse):
+        # leftmost (rightmost if reverse) start of the linker with up to max_errors substitutions, or None
+        linker = self.linkers[type(read)]
+        last_start = len(read) - self.length
+        best = None
+        for piece_start, piece_end in self.pieces:
+            piece = linker[piece_start:piece_end]
+            position = read.rfind(piece) if reverse else read.find(piece)
+            while position >= 0:
+                start = position - piece_start
+                if best is not None and (start <= best if reverse else start >= best):
+                    break
+                if 0 <= start <= last_start and edit_distance(read[start:start + self.length],
+                                                              linker) <= self.max_errors:
+                    best = start
+                    break
+                position = read.rfind(piece, 0, position + len(piece) - 1) if reverse else \
+                    read.find(piece, position + 1)
+        return best
+
+    def search(self, read):
+        if not self.edits:
+            start = self.substitution_start(read, False)
+            return None if start is None else (start, start + self.length)
+        errors, end = bitap_scan(read, 0, len(read), 1, self.forward_masks, self.length, self.max_errors, True,
+                                 False)
+        if errors < 0:
+            return None
+        # scan back from the end for the nearest start with as many errors
+        _, scanned = bitap_scan(read, end - 1, end, -1, self.reverse_masks, self.length, errors, True, True)
+        return end - scanned, end
+
+    def search_reverse(self, read):
+        if not self.edits:
+            start = self.substitution_start(read, True)
+            return None if start is None else (start, start + self.length)
+        errors, scanned = bitap_scan(read, len(read) - 1, len(read), -1, self.reverse_masks, self.length,
+                                     self.max_errors, True, False)
+        if errors < 0:
+            return None
+        start = len(read) - scanned
+        _, scanned = bitap_scan(read, start, len(read) - start, 1, self.forward_masks, self.length, errors, True,
+                                True)
+        return start, start + scanned
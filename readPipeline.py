@@ -0,0 +1,139 @@
+# readPipeline.py runs the reading, decoding and writing of parseBarcodes as a pipeline of three stages
+# (--pipeline N): a reader thread reads the chunks of read pairs, the decoder (this thread, which decodes the chunks
+# itself or hands them to the pool of --workers processes) decodes them, and a writer thread writes the decoded
+# chunks in the order the decoder gives them. The stages hand the chunks over through two bounded queues of N chunks
+# ('input' from the reader to the decoder, 'output' from the decoder to the writer): a stage that runs ahead waits
+# for room in its queue, so at most about 2 N + 3 chunks (and those in flight in --workers processes) are held in
+# memory. Disk reads, decompression, compression and disk writes then overlap with decoding (file I/O, zlib, the
+# compiled kernel and most numpy operations run without the GIL).
+# Every stage counts in its own Counter, merged into the run counts at the end:
+# - 'pipeline:capacity' for N, 'pipeline:<queue>:chunks' for the chunks handed over, 'pipeline:<queue>:depth' for
+#   the chunks already waiting in the queue summed over every hand-over, and 'pipeline:<queue>:max_depth'
+# - 'time:stall:<stage>' for the seconds a stage was blocked: 'reader' (input queue full), 'decoder_input' (input
+#   queue empty), 'decoder_output' (output queue full) and 'writer' (output queue empty)
+# A run whose reader and writer mostly wait on the decoder is CPU-bound; one whose decoder mostly waits on them is
+# I/O-bound (see pipeline_bottleneck of runMetrics).
+import queue
+import threading
+import time
+from collections import Counter
+
+from runMetrics import add_time, timed
+
+# marks the end of the chunks in a queue
+END = object()
+
+# seconds between the checks of a blocked stage for a failure of another stage
+POLL_SECONDS = 0.1
+
+
+class PipelineStopped(Exception):
+    # raised in a stage blocked on a queue once another stage failed
+    pass
+
+
+class StageQueue:
+    # Bounded queue between two stages. put waits while capacity chunks wait in the queue and get while it is empty;
+    # both raise PipelineStopped once stop is set. The time put and get were blocked goes to the stall time of the
+    # stage given, in the counts given (the Counter of the thread that calls them).
+
+    def __init__(self, name, capacity, stop):
+        self.name = name
+        self.chunks = queue.Queue(maxsize=capacity)
+        self.stop = stop
+
+    def put(self, chunk, counts, stage):
+        depth = self.chunks.qsize()
+        counts['pipeline:%s:chunks' % self.name] += 1
+        counts['pipeline:%s:depth' % self.name] += depth
+        counts['pipeline:%s:max_depth' % self.name] = max(counts['pipeline:%s:max_depth' % self.name], depth)
+        self.hand_over(chunk, counts, stage)
+
+    def close(self, counts, stage):
+        # hands over END after the last chunk
+        self.hand_over(END, counts, stage)
+
+    def hand_over(self, chunk, counts, stage):
+        start = time.perf_counter()
+        while True:
+            if self.stop.is_set():
+                raise PipelineStopped()
+            try:
+                self.chunks.put(chunk, timeout=POLL_SECONDS)
+                break
+            except queue.Full:
+                pass
+        add_time(counts, 'stall:' + stage, start)
+
+    def drain(self, counts, stage):
+        # yields the chunks until END
+        while True:
+            start = time.perf_counter()
+            while True:
+                if self.stop.is_set():
+                    raise PipelineStopped()
+                try:
+                    chunk = self.chunks.get(timeout=POLL_SECONDS)
+                    break
+                except queue.Empty:
+                    pass
+            add_time(counts, 'stall:' + stage, start)
+            if chunk is END:
+                return
+            yield chunk
+
+
+def run_pipeline(chunks, decode, write, counts, capacity):
+    # Function 1 "run_pipeline" reads the chunks (an iterable) on a reader thread, decodes them on this thread with
+    # decode (a function of an iterable of chunks that yields the decoded chunks, counting in counts) and writes the
+    # decoded chunks with write(decoded, counts) on a writer thread, through queues of capacity chunks. Reading
+    # counts as parsing time. An error of any stage stops the other two and is raised here.
+    stop = threading.Event()
+    input_queue = StageQueue('input', capacity, stop)
+    output_queue = StageQueue('output', capacity, stop)
+    stage_counts = {'reader': Counter(), 'writer': Counter()}
+    errors = []
+
+    def run_stage(stage, function):
+        # runs a stage thread. Its error (also SystemExit, the program ends on bad input) is raised again below.
+        try:
+            function(stage_counts[stage])
+        except PipelineStopped:
+            pass
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+
+    def read(reader_counts):
+        for chunk in timed(chunks, reader_counts, 'parsing'):
+            input_queue.put(chunk, reader_counts, 'reader')
+        input_queue.close(reader_counts, 'reader')
+
+    def write_decoded(writer_counts):
+        for decoded in output_queue.drain(writer_counts, 'writer'):
+            write(decoded, writer_counts)
+
+    threads = [threading.Thread(target=run_stage, args=('reader', read), name='pipeline-reader', daemon=True),
+               threading.Thread(target=run_stage, args=('writer', write_decoded), name='pipeline-writer',
+                                daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for decoded in decode(input_queue.drain(counts, 'decoder_input')):
+            output_queue.put(decoded, counts, 'decoder_output')
+        output_queue.close(counts, 'decoder_output')
+    except PipelineStopped:
+        pass
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    counts['pipeline:capacity'] = capacity
+    for stage_counter in stage_counts.values():
+        counts.update(stage_counter)
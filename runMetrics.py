@@ -0,0 +1,174 @@
+# runMetrics.py turns the counts of a parseBarcodes run into a metrics report, written as JSON at the end of the
+# run. The decoding functions keep every count in the Counter they already update, under these keys:
+# - read_pairs, matches and one key per rejection reason (REJECT_REASONS)
+# - 'phase:<length>' for the matches per phase block length ('phase:other' for longer phase offsets)
+# - 'corrected:bc1' to 'corrected:bc3' for the matches whose block needed a correction
+# - 'linkers:fixed_offset' and 'linkers:shifted' for the reads whose two linkers were found, at the offsets a phase
+#   block puts them at (LINKER_POSITIONS) or anywhere else
+# - 'time:<stage>' for the seconds spent per stage (STAGES), summed over all chunks (and all worker processes)
+# - 'output_writes' for the writes to the output file and 'time:output_wait' for the seconds spent waiting for
+#   them (see batchWriter)
+# - 'cache_lookups', 'cache_hits', 'cache_evictions' and 'cache_bytes' (memory of the cached entries) for the
+#   decode cache (see decodeCache). Summed over worker processes, each of which has its own cache.
+# - 'check_sampled:<group>', 'check_rejected:<group>:<check>' and 'check_seconds:<group>:<check>' for the sample
+#   of the rejection checks (see checkOrder). With worker processes, the order is that of the summed samples.
+# - 'rescue:<key>' for the counts of the relaxed pass of --rescue over the rejected reads: 'rescue:reads' tried,
+#   'rescue:matches' and the rejections, phase and corrected blocks of the pass. matches and the rejections are
+#   those of the strict pass, so a rescued read is in rejected and in rescue:matches.
+# - 'calibration_reads', 'calibration_seconds:<decoder>' and 'calibration_picked:<decoder>' for --decoder
+#   calibrate (summed over the processes, each of which calibrates on its own first reads)
+# - 'pipeline:capacity', 'pipeline:<queue>:chunks', 'pipeline:<queue>:depth', 'pipeline:<queue>:max_depth' and
+#   'time:stall:<stage>' for the queues and the stalls of the stages of --pipeline (see readPipeline)
+# A Counter of chunk counts merges into the run counts with update, including the stage times, so the report
+# is the same whether chunks are decoded in this process or in a pool of workers.
+import json
+import time
+
+from checkOrder import CHECK_GROUPS, group_orders
+
+# bad_phase is always 0 (phase prefixes are never rejected, see parseBarcodes) and kept for the earlier reports
+REJECT_REASONS = ['bad_linker', 'n_base', 'bad_phase', 'bad_block', 'low_quality']
+
+# decoding covers the whole read 1 decoding step. The python decoder also times its linker search, correction
+# and quality check steps separately (part of decoding, timed read by read and so only with --metrics), as does
+# the relaxed pass of --rescue (rescue).
+STAGES = ['parsing', 'decoding', 'linker_search', 'correction', 'quality_check', 'rescue', 'writing']
+
+# phase blocks of read 1, one per length. parseBarcodes and simulateReads import them from here (the parseBarcodes
+# script itself cannot be imported).
+PHASE_BLOCKS = ['', 'A', 'CT', 'GCA', 'TGCG', 'ATCGA']
+
+# linker positions of the reads whose two linkers were found: 'fixed_offset' where a phase block puts them (linker 1
+# right after the phase block and bc1, linker 2 right after bc2), 'shifted' anywhere else (indels, longer prefixes)
+LINKER_POSITIONS = ['fixed_offset', 'shifted']
+
+# queues and stage stalls of readPipeline
+PIPELINE_QUEUES = ['input', 'output']
+PIPELINE_STALLS = ['reader', 'decoder_input', 'decoder_output', 'writer']
+
+
+def add_time(counts, stage, start):
+    # Function 1 "add_time" adds the time since start (a time.perf_counter value) to stage. Returns the current
+    # time so that consecutive stages can be timed with one call each.
+    now = time.perf_counter()
+    counts['time:' + stage] += now - start
+    return now
+
+
+def phase_key(phase_length):
+    # Function 2 "phase_key" returns the counter key of a phase block length
+    if 0 <= phase_length < len(PHASE_BLOCKS):
+        return 'phase:%d' % phase_length
+    return 'phase:other'
+
+
+def linker_key(linker1_start, linker2_start):
+    # Function 2b "linker_key" returns the counter key of the linker positions of a read (LINKER_POSITIONS)
+    if 6 <= linker1_start < 6 + len(PHASE_BLOCKS) and linker2_start == linker1_start + 21:
+        return 'linkers:fixed_offset'
+    return 'linkers:shifted'
+
+
+def build_report(counts, elapsed):
+    # Function 3 "build_report" collects the metrics of a run from its counts and its wall clock time (seconds)
+    # imported here: decoderBackends imports batchDecoder, which imports runMetrics
+    from decoderBackends import BACKENDS
+    phase_blocks = {phase_block: counts['phase:%d' % length] for length, phase_block in enumerate(PHASE_BLOCKS)}
+    phase_blocks['other'] = counts['phase:other']
+
+    return {
+        'read_pairs': counts['read_pairs'],
+        'matches': counts['matches'],
+        'rejected': {reason: counts[reason] for reason in REJECT_REASONS},
+        'phase_blocks': phase_blocks,
+        'linker_positions': {position: counts['linkers:' + position] for position in LINKER_POSITIONS},
+        'corrected_blocks': {block: counts['corrected:' + block] for block in ['bc1', 'bc2', 'bc3']},
+        'decoded_by': {'numpy': counts['batch_decoded'], 'cython': counts['kernel_decoded']},
+        'elapsed_seconds': round(elapsed, 3),
+        'read_pairs_per_second': round(counts['read_pairs'] / elapsed, 1) if elapsed > 0 else None,
+        'stage_seconds': {stage: round(counts['time:' + stage], 3) for stage in STAGES},
+        'decode_cache': {'lookups': counts['cache_lookups'], 'hits': counts['cache_hits'],
+                         'hit_rate': round(counts['cache_hits'] / counts['cache_lookups'], 4)
+                         if counts['cache_lookups'] else None,
+                         'evictions': counts['cache_evictions'], 'memory_bytes': counts['cache_bytes']},
+        'output': {'writes': counts['output_writes'], 'wait_seconds': round(counts['time:output_wait'], 3)},
+        'check_order': check_order_report(counts),
+        'tiers': tier_report(counts),
+        'calibration': {'reads': counts['calibration_reads'],
+                        'seconds_per_read': {decoder: counts['calibration_seconds:' + decoder] /
+                                             counts['calibration_reads']
+                                             for decoder in BACKENDS if counts['calibration_seconds:' + decoder]},
+                        'picked': {decoder: counts['calibration_picked:' + decoder] for decoder in BACKENDS
+                                   if counts['calibration_picked:' + decoder]}},
+        'pipeline': pipeline_report(counts),
+    }
+
+
+def pipeline_report(counts):
+    # Function 3c "pipeline_report" gives the capacity of the --pipeline queues, the chunks handed over and the mean
+    # and maximum number of chunks waiting in every queue, the stall seconds of every stage and the bottleneck
+    def queue_report(name):
+        chunks = counts['pipeline:%s:chunks' % name]
+        return {'chunks': chunks, 'max_depth': counts['pipeline:%s:max_depth' % name],
+                'mean_depth': round(counts['pipeline:%s:depth' % name] / chunks, 2) if chunks else None}
+    return {
+        'capacity': counts['pipeline:capacity'],
+        'queues': {name: queue_report(name) for name in PIPELINE_QUEUES},
+        'stall_seconds': {stage: round(counts['time:stall:' + stage], 3) for stage in PIPELINE_STALLS},
+        'bottleneck': pipeline_bottleneck(counts),
+    }
+
+
+def pipeline_bottleneck(counts):
+    # Function 3d "pipeline_bottleneck" names the stage the others waited on longest: 'reading' (the decoder waited
+    # for input), 'decoding' (the reader waited for room, the writer for output) or 'writing' (the decoder waited for
+    # room). The writer also waits while the decoder waits for input, which is left out of the wait on decoding.
+    # None without --pipeline.
+    if not counts['pipeline:capacity']:
+        return None
+    waits = {'reading': counts['time:stall:decoder_input'],
+             'decoding': counts['time:stall:reader'] + max(0.0, counts['time:stall:writer'] -
+                                                             counts['time:stall:decoder_input']),
+             'writing': counts['time:stall:decoder_output']}
+    return max(waits, key=waits.get)
+
+
+def tier_report(counts):
+    # Function 3b "tier_report" gives the matches and the yield (matches per read pair) of the strict pass and of
+    # the relaxed pass of --rescue, with the reads the relaxed pass tried, its rejections and its time
+    def read_yield(matches):
+        return round(matches / counts['read_pairs'], 4) if counts['read_pairs'] else None
+    return {
+        'strict': {'matches': counts['matches'], 'yield': read_yield(counts['matches'])},
+        'rescue': {'reads': counts['rescue:reads'], 'matches': counts['rescue:matches'],
+                   'yield': read_yield(counts['rescue:matches']),
+                   'rejected': {reason: counts['rescue:' + reason] for reason in REJECT_REASONS},
+                   'seconds': round(counts['time:rescue'], 3)},
+    }
+
+
+def check_order_report(counts):
+    # Function 3a "check_order_report" lists the order of the rejection checks of every group with the reads
+    # sampled and the rejections and seconds of every check (the fixed order if no reads were sampled)
+    orders = group_orders(counts)
+    return {group: {'sampled_reads': counts['check_sampled:' + group], 'order': orders[group],
+                    'checks': {name: {'rejected': counts['check_rejected:%s:%s' % (group, name)],
+                                      'seconds': round(counts['check_seconds:%s:%s' % (group, name)], 6)}
+                               for name in names}}
+            for group, names in CHECK_GROUPS.items()}
+
+
+def write_report(counts, elapsed, path):
+    # Function 4 "write_report" writes the metrics report of a run as JSON to path
+    with open(path, 'w') as report_file:
+        json.dump(build_report(counts, elapsed), report_file, indent=2)
+        report_file.write('\n')
+
+
+def timed(iterable, counts, stage):
+    # Function 5 "timed" yields the items of iterable and adds the time spent producing each item to stage
+    start = time.perf_counter()
+    for item in iterable:
+        add_time(counts, stage, start)
+        yield item
+        start = time.perf_counter()
@@ -0,0 +1,85 @@
+# runProfiler.py runs a function under cProfile, a stack sampler and tracemalloc for the --profile option of
+# parseBarcodes and compareSam, and writes the results next to each other:
+# - <prefix>.prof       cProfile stats (load with pstats or snakeviz)
+# - <prefix>.txt        the same stats as text, sorted by cumulative time, and the peak traced memory
+# - <prefix>.collapsed  sampled call stacks in collapsed format ("main;read_and_write_sam;decode_chunk 42"),
+#                       the input of flamegraph.pl and speedscope
+# Only the calling process is profiled. Work done in --workers processes shows up as time waiting for results.
+# Nothing here is imported or run unless --profile is given.
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+# seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+# GIL switch interval while profiling. The default (5 ms) lets the sampler in mostly where the profiled thread
+# releases the GIL (in regex searches, file I/O), which skews the sampled stacks towards those calls.
+PROFILE_SWITCH_INTERVAL = 0.0002
+
+
+def frame_label(frame):
+    # Function 1 "frame_label" names a stack frame as function (file:line of the def)
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler(threading.Thread):
+    # Samples the call stack of one thread every interval seconds until stop is called. stacks counts the samples
+    # per stack, as tuples of frame labels from the outermost call inwards.
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as collapsed_file:
+            for stack, samples in sorted(self.stacks.items()):
+                collapsed_file.write(';'.join(stack) + ' ' + str(samples) + '\n')
+
+
+def profile_run(function, prefix):
+    # Function 2 "profile_run" calls function() with profiling on and writes the profile files for prefix.
+    # Returns the result of function.
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident())
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(PROFILE_SWITCH_INTERVAL)
+    tracemalloc.start()
+    sampler.start()
+    profiler.enable()
+    try:
+        return function()
+    finally:
+        profiler.disable()
+        sampler.stop()
+        sys.setswitchinterval(switch_interval)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        profiler.dump_stats(prefix + '.prof')
+        sampler.write_collapsed(prefix + '.collapsed')
+        with open(prefix + '.txt', 'w') as stats_file:
+            stats_file.write('Peak traced memory: %.1f MiB\n\n' % (peak_memory / 1024 / 1024))
+            pstats.Stats(profiler, stream=stats_file).sort_stats('cumulative').print_stats()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# setup.py builds the compiled editDistance extension ahead of time, so that parseBarcodes never compiles anything
+# when it starts:
+#   python setup.py build_ext --inplace   builds editDistance next to the scripts, to run them from this directory
+#   pip install .                         installs the modules, the extension and the scripts
+# The extension is built from editDistance.pyx if Cython is installed, otherwise from editDistance.c (generated
+# from it with cython -3 editDistance.pyx and kept in the repository), which only needs a C compiler. The build is
+# optional: without a compiler the install still succeeds and parseBarcodes runs with the pure Python fallbacks of
+# pureEditDistance.py (see decoderBackends.py).
+from setuptools import setup, Extension
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
+if cythonize is not None:
+    extensions = cythonize([Extension('editDistance', ['editDistance.pyx'])], compiler_directives={'language_level': 3})
+else:
+    extensions = [Extension('editDistance', ['editDistance.c'])]
+# a failed build only warns (cythonize does not keep the flag, so it is set afterwards)
+for extension in extensions:
+    extension.optional = True
+
+setup(
+    name='kim-ddseq-barcode',
+    version='1.6.1',
+    description='Barcode extraction and read tagging for BioRad ddSeq reads',
+    py_modules=['alignmentIO', 'batchDecoder', 'batchWriter', 'checkOrder', 'decodeCache', 'decoderBackends',
+                'packedBarcodes', 'pureEditDistance', 'readPipeline', 'runMetrics', 'runProfiler'],
+    scripts=['parseBarcodes-N1.6.1.py', 'compareSam.py', 'simulateReads.py'],
+    ext_modules=extensions,
+    extras_require={'bam': ['pysam'], 'numpy': ['numpy']},
+)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import argparse  # command line options
+import math
+import random
+from alignmentIO import is_bam, open_text, BamTextWriter
+from runMetrics import PHASE_BLOCKS  # phase blocks of read 1, as in parseBarcodes
+
+# Summary:
+# simulateReads.py writes synthetic ddSeq read pairs for benchmarking and accuracy tests of parseBarcodes.
+# Read 1 has the real structure (phase block, bc1, linker 1, bc2, linker 2, bc3, ACG anchor, UMI, GAC anchor and
+# a poly-T tail) with blocks drawn from the barcode blocks file. Read 2 is a random cDNA sequence.
+# Errors are added to read 1 at the given rates per base: substitutions, insertions, deletions and N bases, and
+# low quality (q-score below 10) values in the quality string. A fraction of read 1 sequences can be random
+# (no structure at all).
+# The pairs are written as unmapped SAM or BAM (as FastqToSam would, read 1 then read 2) or as a pair of
+# (gzipped) FASTQ files. The truth file lists the barcode every read pair was made with, next to the number of
+# errors of each kind that went into read 1, so decoded barcodes can be checked against it. The empty phase block
+# is written as -.
+# The same seed always gives the same reads.
+
+# Read 1 structure, as in parseBarcodes
+LINKER1 = 'TAGCCATCGCATTGC'
+LINKER2 = 'TACCTCTGAGCTGAA'
+
+BASES = 'ACGT'
+# str.translate table turning a hex digit (4 random bits) into 2 random bases
+HEX_TO_BASES = str.maketrans({'%x' % digit: BASES[digit >> 2] + BASES[digit & 3] for digit in range(16)})
+# quality characters: q-score 30-40 for good bases, 2-9 for low quality bases
+HIGH_QUALITIES = [chr(33 + q) for q in range(30, 41)]
+LOW_QUALITIES = [chr(33 + q) for q in range(2, 10)]
+# good quality strings are cut from a pool of this many random good quality values
+QUALITY_POOL_SIZE = 1 << 16
+
+TRUTH_HEADER = '#name\tcell_barcode\tumi\tphase_block\tsubstitutions\tinsertions\tdeletions\tn_bases\t' \
+               'low_quality_bases\n'
+
+# read pairs generated and written at a time
+CHUNK_SIZE = 10000
+
+
+def random_bases(length, rng):
+    # Function 1 "random_bases" returns length random bases, made from one draw of random bits
+    n_hex = (length + 1) // 2
+    return ('%0*x' % (n_hex, rng.getrandbits(4 * n_hex))).translate(HEX_TO_BASES)[:length]
+
+
+def next_event(rng, log_no_event):
+    # Function 2 "next_event" returns how many positions to skip until the next event, for an event probability
+    # per position p given as log(1 - p) (geometric distribution). Skipping to the next error instead of rolling
+    # a random number for every base keeps the generator fast at low error rates.
+    return int(math.log(1.0 - rng.random()) / log_no_event)
+
+
+def add_errors(seq, rates, rng):
+    # Function 3 "add_errors" adds substitutions, insertions, deletions and N bases to seq with the per base
+    # probabilities in rates (substitution, insertion, deletion, N). Returns the new sequence and the number of
+    # errors of each kind.
+    total_rate = sum(rates)
+    errors = [0, 0, 0, 0]
+    if total_rate <= 0:
+        return seq, errors
+
+    log_no_event = math.log(1.0 - min(total_rate, 0.999999))
+    pieces = []
+    start = 0
+    position = next_event(rng, log_no_event)
+    while position < len(seq):
+        pieces.append(seq[start:position])
+        kind = rng.choices(range(4), weights=rates)[0]
+        errors[kind] += 1
+        base = seq[position]
+        if kind == 0:  # substitution
+            pieces.append(rng.choice(BASES.replace(base, '')))
+        elif kind == 1:  # insertion after the base
+            pieces.append(base + rng.choice(BASES))
+        elif kind == 3:  # N base
+            pieces.append('N')
+        # a deletion appends nothing
+        start = position + 1
+        position = start + next_event(rng, log_no_event)
+    pieces.append(seq[start:])
+
+    return ''.join(pieces), errors
+
+
+def make_quality(length, low_quality_rate, quality_pool, rng):
+    # Function 4 "make_quality" returns a quality string of length values, cut from quality_pool at a random
+    # offset, with low quality values at the given rate, and the number of low quality values
+    offset = rng.randrange(len(quality_pool) - length)
+    quality = quality_pool[offset:offset + length]
+    low_quality = 0
+    if low_quality_rate > 0:
+        quality = list(quality)
+        log_no_event = math.log(1.0 - min(low_quality_rate, 0.999999))
+        position = next_event(rng, log_no_event)
+        while position < length:
+            quality[position] = rng.choice(LOW_QUALITIES)
+            low_quality += 1
+            position += 1 + next_event(rng, log_no_event)
+    return ''.join(quality), low_quality
+
+
+def make_read1(blocks, args, quality_pool, rng):
+    # Function 5 "make_read1" builds one read 1. Returns the sequence, quality string and its truth fields
+    # (cell barcode, UMI, phase block and error counts). Random reads have * for barcode, UMI and phase block.
+    if rng.random() < args.random_rate:
+        seq = random_bases(args.read_length, rng)
+        quality, low_quality = make_quality(args.read_length, args.low_quality_rate, quality_pool, rng)
+        return seq, quality, ['*', '*', '*', 0, 0, 0, 0, low_quality]
+
+    phase_block = rng.choice(PHASE_BLOCKS)
+    bc1, bc2, bc3 = rng.choice(blocks), rng.choice(blocks), rng.choice(blocks)
+    umi = random_bases(8, rng)
+    structure = phase_block + bc1 + LINKER1 + bc2 + LINKER2 + bc3 + 'ACG' + umi + 'GAC'
+    template = structure + 'T' * max(args.read_length - len(structure), 0)
+
+    seq, errors = add_errors(template[:args.read_length], args.error_rates, rng)
+    # insertions and deletions change the length. Cut back or extend the poly-T tail to the read length.
+    seq = (seq + 'T' * args.read_length)[:args.read_length]
+    quality, low_quality = make_quality(args.read_length, args.low_quality_rate, quality_pool, rng)
+
+    return seq, quality, [bc1 + bc2 + bc3, umi, phase_block or '-'] + errors + [low_quality]
+
+
+def generate_chunks(blocks, args):
+    # Function 6 "generate_chunks" yields lists of up to CHUNK_SIZE (name, read 1 sequence, read 1 quality,
+    # read 2 sequence, read 2 quality, truth fields) tuples until args.reads read pairs are made
+    rng = random.Random(args.seed)
+    pool_size = QUALITY_POOL_SIZE + args.read_length + args.read2_length
+    quality_pool = ''.join(rng.choices(HIGH_QUALITIES, k=pool_size))
+    made = 0
+    while made < args.reads:
+        chunk = []
+        for i in range(made, min(made + CHUNK_SIZE, args.reads)):
+            seq1, qual1, truth = make_read1(blocks, args, quality_pool, rng)
+            seq2 = random_bases(args.read2_length, rng)
+            qual2, _ = make_quality(args.read2_length, 0, quality_pool, rng)
+            chunk.append(('SIM:%d' % i, seq1, qual1, seq2, qual2, truth))
+        made += len(chunk)
+        yield chunk
+
+
+def format_sam_pair(name, seq1, qual1, seq2, qual2):
+    # Function 7 "format_sam_pair" writes a read pair as two unmapped SAM records (flags 77 and 141, as FastqToSam)
+    return "%s\t77\t*\t0\t0\t*\t*\t0\t0\t%s\t%s\tRG:Z:A\n%s\t141\t*\t0\t0\t*\t*\t0\t0\t%s\t%s\tRG:Z:A\n" % (
+        name, seq1, qual1, name, seq2, qual2)
+
+
+def main():
+    # Main function
+    parser = argparse.ArgumentParser(description='Write synthetic ddSeq read pairs (SAM, BAM or paired FASTQ) '
+                                                 'with a ground truth file of their barcodes.')
+    required_group = parser.add_argument_group('required arguments')
+    required_group.add_argument("-blocks", help='file containing barcode blocks', required=True, metavar='FILE')
+    required_group.add_argument("-reads", help='number of read pairs', required=True, type=int, metavar='N')
+    output_group = parser.add_argument_group('output (either -output or -read1 and -read2)')
+    output_group.add_argument("-output", help='.sam or .bam output file, - for SAM to stdout', metavar='FILE')
+    output_group.add_argument("-read1", help='read 1 .fastq or .fastq.gz output file', metavar='FILE')
+    output_group.add_argument("-read2", help='read 2 .fastq or .fastq.gz output file', metavar='FILE')
+    parser.add_argument("--truth", help='write the barcode, UMI, phase block and error counts of every read pair '
+                                        'to this tab separated file', metavar='FILE')
+    parser.add_argument("--seed", help='random seed (default: 1)', type=int, default=1, metavar='N')
+    parser.add_argument("--read-length", help='read 1 length (default: 68)', type=int, default=68, metavar='N')
+    parser.add_argument("--read2-length", help='read 2 length (default: 75)', type=int, default=75, metavar='N')
+    parser.add_argument("--substitution-rate", help='read 1 substitutions per base (default: 0.005)', type=float,
+                        default=0.005, metavar='RATE')
+    parser.add_argument("--insertion-rate", help='read 1 insertions per base (default: 0.0005)', type=float,
+                        default=0.0005, metavar='RATE')
+    parser.add_argument("--deletion-rate", help='read 1 deletions per base (default: 0.0005)', type=float,
+                        default=0.0005, metavar='RATE')
+    parser.add_argument("--n-rate", help='read 1 N bases per base (default: 0.001)', type=float, default=0.001,
+                        metavar='RATE')
+    parser.add_argument("--low-quality-rate", help='read 1 quality values below q-score 10 per base '
+                                                   '(default: 0.002)', type=float, default=0.002, metavar='RATE')
+    parser.add_argument("--random-rate", help='fraction of read 1 sequences without any structure (default: 0.02)',
+                        type=float, default=0.02, metavar='RATE')
+    parser.add_argument("--threads", help='BGZF compression threads for .bam output (default: 4)', type=int,
+                        default=4, metavar='N')
+    args = parser.parse_args()
+
+    fastq_output = args.read1 or args.read2
+    if fastq_output and (args.output or not (args.read1 and args.read2)):
+        parser.error('give either -output, or both -read1 and -read2')
+    if not fastq_output and not args.output:
+        parser.error('one of -output or -read1/-read2 is required')
+    args.error_rates = [args.substitution_rate, args.insertion_rate, args.deletion_rate, args.n_rate]
+    if min(args.error_rates + [args.low_quality_rate, args.random_rate]) < 0 or sum(args.error_rates) >= 1:
+        parser.error('rates must be non-negative and the read 1 error rates must add up to less than 1')
+
+    with open(args.blocks, 'r') as barcode_blocks_fh:
+        blocks = barcode_blocks_fh.read().splitlines()
+
+    if fastq_output:
+        read1_file = open_text(args.read1, 'w')
+        read2_file = open_text(args.read2, 'w')
+    elif is_bam(args.output):
+        sam_file = BamTextWriter(args.output, ['@HD\tVN:1.5\tSO:unsorted\n', '@RG\tID:A\tSM:simulated\n'],
+                                 threads=args.threads)
+    else:
+        sam_file = open_text(args.output, 'w')
+        sam_file.write('@HD\tVN:1.5\tSO:unsorted\n@RG\tID:A\tSM:simulated\n')
+    truth_file = open(args.truth, 'w') if args.truth else None
+    if truth_file:
+        truth_file.write(TRUTH_HEADER)
+
+    for chunk in generate_chunks(blocks, args):
+        if fastq_output:
+            read1_file.write(''.join('@%s/1\n%s\n+\n%s\n' % (name, seq1, qual1)
+                                     for name, seq1, qual1, _, _, _ in chunk))
+            read2_file.write(''.join('@%s/2\n%s\n+\n%s\n' % (name, seq2, qual2)
+                                     for name, _, _, seq2, qual2, _ in chunk))
+        else:
+            sam_file.write(''.join(format_sam_pair(*pair[:5]) for pair in chunk))
+        if truth_file:
+            truth_file.write(''.join(name + '\t' + '\t'.join(map(str, truth)) + '\n'
+                                     for name, _, _, _, _, truth in chunk))
+
+    if fastq_output:
+        read1_file.close()
+        read2_file.close()
+    else:
+        sam_file.close()
+    if truth_file:
+        truth_file.close()
+
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+# test_decoderBackends.py checks that the read 1 decoders of decoderBackends give the same results and counts, and
+# that LinkerSearch finds the linkers where the fuzzy regex searches of the first versions did.
+# The reads are made with simulateReads, plus reads the decoders handle apart: short reads, reads full of N bases and
+# reads whose quality string has another length than the sequence.
+# Run from the repository directory with python -m pytest tests. The numpy and cython checks are skipped when numpy
+# or the compiled extension (python setup.py build_ext --inplace) is missing.
+import argparse
+import importlib.util
+import os
+import random
+import sys
+from collections import Counter
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import pureEditDistance  # noqa: E402
+import simulateReads  # noqa: E402
+from decoderBackends import available_backends, editDistance  # noqa: E402
+
+LINKERS = [simulateReads.LINKER1, simulateReads.LINKER2]
+
+# counts that tell which decoder did the work, or how long it took, rather than what it found
+DECODER_COUNTS = ('batch_decoded', 'kernel_decoded')
+
+needs_extension = pytest.mark.skipif(editDistance is None, reason='editDistance extension not built')
+
+
+def load_parse_barcodes():
+    # the parseBarcodes script, imported as a module (its name is not a module name)
+    spec = importlib.util.spec_from_file_location('parseBarcodes',
+                                                  os.path.join(REPO_DIR, 'parseBarcodes-N1.6.1.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+parse_barcodes = load_parse_barcodes()
+
+
+@pytest.fixture(scope='module')
+def correction_index():
+    blocks = parse_barcodes.get_ref_barcode_blocks(os.path.join(REPO_DIR, 's_input', 'barcodeBlocks.txt'))
+    return parse_barcodes.build_correction_index(blocks)
+
+
+@pytest.fixture(scope='module')
+def read1s(correction_index):
+    # read 1 sequences and quality strings: simulated reads with errors, then the odd ones
+    blocks = sorted(set(block for block in correction_index.values() if block))
+    args = argparse.Namespace(read_length=68, random_rate=0.05, error_rates=[0.01, 0.004, 0.004, 0.002],
+                              low_quality_rate=0.004)
+    rng = random.Random(23)
+    quality_pool = ''.join(rng.choices(simulateReads.HIGH_QUALITIES, k=simulateReads.QUALITY_POOL_SIZE))
+    seqs, quals = [], []
+    for _ in range(3000):
+        seq, qual, _ = simulateReads.make_read1(blocks, args, quality_pool, rng)
+        seqs.append(seq)
+        quals.append(qual)
+
+    good_seq, good_qual = seqs[0], quals[0]
+    odd_reads = []
+    # short reads, down to shorter than a linker
+    odd_reads += [(seq[:length], qual[:length]) for seq, qual in zip(seqs[:40], quals[:40])
+                  for length in (0, 5, 14, 15, 21, 36, 45, 50, 56, 60, 64)]
+    # N-rich reads, and reads with a single N at every position
+    odd_reads += [(''.join('N' if rng.random() < 0.15 else base for base in seq), qual)
+                  for seq, qual in zip(seqs[40:240], quals[40:240])]
+    odd_reads += [(good_seq[:k] + 'N' + good_seq[k + 1:], good_qual) for k in range(len(good_seq))]
+    odd_reads.append(('N' * len(good_seq), good_qual))
+    # quality strings shorter or longer than the sequence
+    odd_reads += [(seq, qual[:-1]) for seq, qual in zip(seqs[240:340], quals[240:340])]
+    odd_reads += [(seq, qual + 'I') for seq, qual in zip(seqs[340:440], quals[340:440])]
+    # linker 1 too close to the start for a phase block, or after a prefix longer than any phase block
+    odd_reads += [(seq[k:], qual[k:]) for seq, qual in zip(seqs[440:500], quals[440:500]) for k in (3, 6)]
+    odd_reads += [(prefix + seq[:68 - len(prefix)], qual) for seq, qual in zip(seqs[500:560], quals[500:560])
+                  for prefix in ('GG', 'TTTTTTT')]
+    # reads of other lengths, decoded in groups of their own by the numpy decoder
+    odd_reads += [(seq + 'TTTTT', qual + 'IIIII') for seq, qual in zip(seqs[560:600], quals[560:600])]
+
+    seqs += [seq for seq, _ in odd_reads]
+    quals += [qual for _, qual in odd_reads]
+    return seqs, quals
+
+
+def decoder_counts(counts):
+    # the counts every decoder must agree on
+    return {key: count for key, count in counts.items()
+            if count and key[:5] != 'time:' and key not in DECODER_COUNTS}
+
+
+def backend_params():
+    return [pytest.param(backend, marks=pytest.mark.skipif(backend not in available_backends(),
+                                                           reason=backend + ' decoder not available'))
+            for backend in ['numpy', 'cython']]
+
+
+def encode_reads(read1s, correction_index):
+    seqs, quals = read1s
+    return [seq.encode() for seq in seqs], [qual.encode() for qual in quals], \
+        parse_barcodes.encode_correction_index(correction_index)
+
+
+@pytest.mark.parametrize('binary', [False, True], ids=['str', 'bytes'])
+@pytest.mark.parametrize('backend', backend_params())
+def test_decoders_match_python(backend, binary, read1s, correction_index):
+    seqs, quals = read1s
+    if binary:
+        seqs, quals, correction_index = encode_reads(read1s, correction_index)
+
+    expected_counts = Counter()
+    expected = parse_barcodes.decode_read1_list(seqs, quals, correction_index, expected_counts, 'python')
+    counts = Counter()
+    results = parse_barcodes.decode_read1_list(seqs, quals, correction_index, counts, backend)
+
+    assert expected_counts['matches'] > 1000
+    assert results == expected
+    assert decoder_counts(counts) == decoder_counts(expected_counts)
+
+
+@needs_extension
+def test_threaded_kernel_matches_python(read1s, correction_index):
+    seqs, quals = read1s
+    expected_counts = Counter()
+    expected = parse_barcodes.decode_read1_list(seqs, quals, correction_index, expected_counts, 'python')
+    counts = Counter()
+    results = parse_barcodes.decode_read1_list(seqs, quals, correction_index, counts, 'cython', decode_threads=3)
+
+    assert results == expected
+    assert decoder_counts(counts) == decoder_counts(expected_counts)
+
+
+@needs_extension
+@pytest.mark.parametrize('backend', backend_params() + ['python'])
+def test_sam_buffer_matches_split_records(backend, read1s, correction_index):
+    # --binary: SAM records decoded in place (SamPairs) against the records split into fields
+    seqs, quals, correction_index = encode_reads(read1s, correction_index)
+    buffer = b''.join(simulateReads.format_sam_pair('SIM:%d' % i, seq.decode() or '*', qual.decode() or '*',
+                                                    'ACGT', 'IIII').encode()
+                      for i, (seq, qual) in enumerate(zip(seqs, quals)))
+
+    expected_counts = Counter()
+    expected = parse_barcodes.decode_chunk(buffer.splitlines(True), correction_index, expected_counts, 'python')
+    counts = Counter()
+    records = parse_barcodes.decode_sam_buffer(buffer, correction_index, counts, backend)
+
+    assert records == expected
+    assert decoder_counts(counts) == decoder_counts(expected_counts)
+
+
+def linker_searches():
+    searches = [pytest.param(pureEditDistance.LinkerSearch, id='pure')]
+    if editDistance is not None:
+        searches.append(pytest.param(editDistance.LinkerSearch, id='compiled'))
+    return searches
+
+
+def mutate(sequence, substitutions, rng):
+    # sequence with substitutions bases replaced by other bases
+    bases = list(sequence)
+    for position in rng.sample(range(len(bases)), substitutions):
+        bases[position] = rng.choice([base for base in 'ACGTN' if base != bases[position]])
+    return ''.join(bases)
+
+
+@pytest.mark.parametrize('linker', LINKERS)
+@pytest.mark.parametrize('search_class', linker_searches())
+def test_linker_search_matches_regex(search_class, linker):
+    regex = pytest.importorskip('regex')
+    forward = regex.compile('(%s){s<=1}' % linker)
+    reverse = regex.compile('(?r)(%s){s<=1}' % linker)
+    search = search_class(linker)
+    rng = random.Random(15)
+
+    for _ in range(3000):
+        read = ''.join(rng.choice('ACGTN' if rng.random() < 0.1 else 'ACGT') for _ in range(rng.randrange(0, 80)))
+        # 0 to 3 copies of the linker with up to 2 substitutions, possibly overlapping
+        for _ in range(rng.randrange(4)):
+            if len(read) >= len(linker):
+                start = rng.randrange(len(read) - len(linker) + 1)
+                read = read[:start] + mutate(linker, rng.randrange(3), rng) + read[start + len(linker):]
+
+        expected_forward = forward.search(read)
+        expected_reverse = reverse.search(read)
+        for text in (read, read.encode()):
+            assert search.search(text) == (expected_forward.span(1) if expected_forward else None), read
+            assert search.search_reverse(text) == (expected_reverse.span(1) if expected_reverse else None), read